@@ -4,9 +4,13 @@
 # 
 # Script for demultiplexing multiple genomes as a batch
 #
+# Since revision 3 all samples are demultiplexed in a single pass and written together into one output directory
+# (-o, default Demultiplexed_reads) as SampleID_R1.fastq.gz and SampleID_R2.fastq.gz, with one demultiplex_log.txt.
+# Earlier revisions wrote each sample to a directory named after its GenomeID.
+#
 # Created by Michael C. Nelson on 2015-05-16.
-# Last revised: 2015-06-10
-# Revision #: 2
+# Last revised: 2026-10-18
+# Revision #: 4
 # Copyright 2015 Michael C. Nelson and the University of Connecticut. All rights reserved.
 #
 # This script is free software: you can redistribute it and/or modify
@@ -32,6 +36,9 @@ function HELP {
     echo "-r  The path to the Undetermined Read 2 file."
     echo "-b  The path to the Undetermined Index file."
     echo "Optional arguments."
+    echo "-o  The output directory to write all samples to. Default: Demultiplexed_reads"
+    echo "    All samples go into this one directory, rather than into a directory per GenomeID as before revision 3."
+    echo "-c  Continue an interrupted run from its last checkpoint, skipping the samples that are already finished."
     echo "-h  Displays this help message. No further functions are performed."\\n
     echo "Example usage:\\n$SCRIPT -f Undetermined_R1.fastq.gz -r Undetermined_R2.fastq.gz -b Undetermined_I1.fastq.gz Genome1ID N701 Genome2ID N702 ..."\\n
     exit 1
@@ -44,17 +51,21 @@ if [ $# -eq 0 ]; then
 fi
 
 ### Start getopts code ###
-while getopts :f:r:b:h FLAG; do
+OUTDIR=Demultiplexed_reads
+RESUME=
+while getopts :f:r:b:o:ch FLAG; do
     case $FLAG in
         f) FREADS=$OPTARG;;
         r) RREADS=$OPTARG;;
         b) BREADS=$OPTARG;;
+        o) OUTDIR=$OPTARG;;
+        c) RESUME=--resume;;
         h) HELP;;
         '?') # Unrecognized option
             echo \\n"ERROR: Option -$OPTARG not recognized. See help (-h)."\\n
             exit 2
         ;;
-        :)  # No argument given for an option (f,r,b)
+        :)  # No argument given for an option (f,r,b,o)
             echo "Option -$OPTARG requires an argument. See help (-h)."\\n
             exit 2
         ;;
@@ -107,14 +118,11 @@ START=`date +%s`
 echo "Using $FREADS as the Read1 file.\\nUsing $RREADS as the Read2 file.\\nUsing $BREADS as the Index sequence file." | tee -a $LOG
 
 ## Demultiplexing code block, should never be necessary to change.
-while [ $1 ]
-    do
-    echo '' | tee -a $LOG
-    echo "Processing sample $1 using index $2" | tee -a $LOG
-    demultiplex_reads.py -f $FREADS -r $RREADS -b $BREADS -o $1 -n $1 -i $2
-    echo "Demultiplexing of sample $1 done!" | tee -a $LOG
-    shift 2
-done
+## All samples are demultiplexed together in a single pass over the input files.
+echo '' | tee -a $LOG
+echo "Processing samples $* into $OUTDIR" | tee -a $LOG
+demultiplex_reads.py -f $FREADS -r $RREADS -b $BREADS -o $OUTDIR $RESUME -p "$@"
+cat $OUTDIR/demultiplex_log.txt | tee -a $LOG
 
 END=`date +%s`
 RUNTIME=$(( END - START ))
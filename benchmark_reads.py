@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Generate a reproducible synthetic MiSeq run and measure the throughput of the demultiplexing and filtering code on it,
+benchmark_reads.py generate -o Bench_run/ -n 1000000 -l 250 -x N701 N702 N703 --error_rate 0.005
+benchmark_reads.py run -d Bench_run/ -o results.json
+benchmark_reads.py compare old_results.json results.json
+
+Every benchmark is run in its own process so that the peak memory reported is its own, and a benchmark that raises or
+whose process dies is reported as failed. Input files are opened with fastq_input.open_fastq, as the scripts open them. The end to end benchmarks run
+parse_paired_reads, filter_paired_fastq and filter_fastq over the whole run. The per stage benchmarks time decompression
+and parsing of the whole run, and header checks, index matching, formatting and compression on the first --stage_reads
+reads held in memory.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import string
+import sys
+import time
+import traceback
+from Queue import Empty
+from itertools import islice, izip
+from math import log
+from multiprocessing import Process, Queue
+
+import demultiplex_reads
+import dual_fastq_filter
+import fastq_filter
+from demultiplex_reads import Indices, assign_sample, build_barcode_lookup, check_seq_headers, get_barcode_lengths
+from fastq_input import open_fastq
+from fastq_parser import BLOCK_SIZE, fastqparser
+from gzip_writer import GzipWriter, fastq_extension
+from parallel_batches import format_records
+from read_id_index import ReadIDIndex
+
+BASE_TABLE = string.maketrans(''.join(map(chr, range(256))), 'ACGT' * 64)
+QUALITY_TABLE = string.maketrans(''.join(map(chr, range(256))), 'I' * 160 + 'H' * 40 + 'G' * 24 + 'F' * 16 + '#' * 16)
+
+# Number of reads generated at a time
+GENERATE_CHUNK = 10000
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest='command')
+
+generate_parser = subparsers.add_parser('generate', help="Generate a synthetic Undetermined R1/R2/I1 set.")
+generate_parser.add_argument('-o', '--output_dir', required=True, help="The output directory to create the files in. [REQUIRED]", metavar='Bench_run')
+generate_parser.add_argument('-n', '--num_reads', required=False, type=int, default=1000000, help="The number of read pairs to generate. Default: 1000000", metavar='1000000')
+generate_parser.add_argument('-l', '--read_length', required=False, type=int, default=250, help="The length of Read 1 and Read 2. Default: 250", metavar='250')
+generate_parser.add_argument('-x', '--indices', required=False, nargs='+', default=['N701', 'N702', 'N703', 'N704'], help="The names of the indices to draw barcodes from. Default: N701 N702 N703 N704", metavar='N701')
+generate_parser.add_argument('-u', '--undetermined_fraction', required=False, type=float, default=0.1, help="The fraction of reads given a random index. Default: 0.1", metavar='0.1')
+generate_parser.add_argument('-e', '--error_rate', required=False, type=float, default=0.0, help="The per-base substitution rate of the index reads. Default: 0", metavar='0.005')
+generate_parser.add_argument('-z', '--compress_level', required=False, type=int, default=1, choices=range(10), help="The gzip compression level of the files, 0 writes plain fastq files. Default: 1", metavar='1')
+generate_parser.add_argument('-s', '--seed', required=False, type=int, default=1, help="The random seed. Default: 1", metavar='1')
+
+run_parser = subparsers.add_parser('run', help="Run the benchmarks on a generated run.")
+run_parser.add_argument('-d', '--data_dir', required=True, help="The directory of a generated run. [REQUIRED]", metavar='Bench_run')
+run_parser.add_argument('-o', '--output', required=True, help="The JSON results file to create. [REQUIRED]", metavar='results.json')
+run_parser.add_argument('-b', '--benchmarks', required=False, nargs='+', help="Only run these benchmarks. Default: all", metavar='parse')
+run_parser.add_argument('-e', '--max_barcode_errors', required=False, type=int, default=0, help="The number of index mismatches allowed when matching. Default: 0", metavar='0')
+run_parser.add_argument('-k', '--keep_every', required=False, type=int, default=10, help="Keep every kth read in the filter benchmarks. Default: 10", metavar='10')
+run_parser.add_argument('-z', '--compress_level', required=False, type=int, default=6, choices=range(10), help="The gzip compression level of the outputs. Default: 6", metavar='6')
+run_parser.add_argument('--compress_threads', required=False, type=int, default=1, help="The number of threads to compress outputs with. Default: 1", metavar='1')
+run_parser.add_argument('--stage_reads', required=False, type=int, default=500000, help="The number of reads held in memory for the per stage benchmarks. Default: 500000", metavar='500000')
+
+compare_parser = subparsers.add_parser('compare', help="Compare two results files, exiting with status 1 on a regression.")
+compare_parser.add_argument('baseline', help="The earlier results file.", metavar='old_results.json')
+compare_parser.add_argument('current', help="The later results file.", metavar='results.json')
+compare_parser.add_argument('-t', '--tolerance', required=False, type=float, default=0.1, help="The fractional drop in reads/s reported as a regression. Default: 0.1", metavar='0.1')
+
+
+def random_string(rng, length, table):
+    """ Returns a string of random characters from a 256 entry translation table """
+    if not length:
+        return ''
+    return ('%0*x' % (length * 2, rng.getrandbits(length * 8))).decode('hex').translate(table)
+
+
+def add_errors(rng, index_seqs, index_length, error_rate):
+    """ Substitutes random bases (N included) into the index sequences at the given per-base rate """
+    total_length = len(index_seqs) * index_length
+    position = -1
+    while True:
+        position += int(log(1.0 - rng.random()) / log(1.0 - error_rate)) + 1    # Geometric gap to the next error
+        if position >= total_length:
+            break
+        read_num, base_num = divmod(position, index_length)
+        index_seq = index_seqs[read_num]
+        index_seqs[read_num] = index_seq[:base_num] + rng.choice('ACGTN'.replace(index_seq[base_num], '')) + index_seq[base_num + 1:]
+
+
+def run_file_names(data_dir, compress_level):
+    """ Returns the R1, R2 and I1 file paths of a generated run """
+    return ['%s/Undetermined_S0_L001_%s_001%s' % (data_dir, read, fastq_extension(compress_level)) for read in ('R1', 'R2', 'I1')]
+
+
+def generate_run(output_dir, num_reads, read_length, index_names, undetermined_fraction, error_rate, compress_level, seed):
+    """ Writes a synthetic Undetermined R1/R2/I1 set, returning the settings it was generated with """
+    rng = random.Random(seed)
+    index_seqs_used = [Indices[name] for name in index_names]
+    index_length = max(len(index_seq) for index_seq in index_seqs_used)
+    demultiplex_reads.create_dir(output_dir, fail_on_exist=False)
+    writers = [GzipWriter(fp, compress_level) for fp in run_file_names(output_dir, compress_level)]
+
+    for chunk_start in xrange(0, num_reads, GENERATE_CHUNK):
+        chunk_reads = min(GENERATE_CHUNK, num_reads - chunk_start)
+        index_seqs = []
+        for i in xrange(chunk_reads):
+            if rng.random() < undetermined_fraction:
+                index_seqs.append(random_string(rng, index_length, BASE_TABLE))
+            else:
+                index_seq = rng.choice(index_seqs_used)
+                index_seqs.append(index_seq + random_string(rng, index_length - len(index_seq), BASE_TABLE))
+        if error_rate:
+            add_errors(rng, index_seqs, index_length, error_rate)
+
+        bases = random_string(rng, 2 * chunk_reads * read_length, BASE_TABLE)
+        qualities = random_string(rng, 2 * chunk_reads * read_length, QUALITY_TABLE)
+        chunks = ([], [], [])
+        for i in xrange(chunk_reads):
+            read_num = chunk_start + i
+            tile, position = divmod(read_num, 600000)
+            header = 'M00123:45:000000000-A1B2C:1:%d:%d:%d' % (1101 + tile, 1000 + position % 25000, 1000 + position / 25000)
+            start1 = 2 * i * read_length
+            start2 = start1 + read_length
+            chunks[0].append('@%s 1:N:0:1\n%s\n+\n%s\n' % (header, bases[start1:start2], qualities[start1:start2]))
+            chunks[1].append('@%s 2:N:0:1\n%s\n+\n%s\n' % (header, bases[start2:start2 + read_length], qualities[start2:start2 + read_length]))
+            chunks[2].append('@%s 1:N:0:1\n%s\n+\n%s\n' % (header, index_seqs[i], qualities[start1:start1 + index_length]))
+        for writer, chunk in izip(writers, chunks):
+            writer.write(''.join(chunk))
+
+    for writer in writers:
+        writer.close()
+    return {'num_reads': num_reads, 'read_length': read_length, 'indices': index_names, 'undetermined_fraction': undetermined_fraction,
+            'error_rate': error_rate, 'compress_level': compress_level, 'seed': seed}
+
+
+def load_records(fps, num_reads):
+    """ Returns lists of the first num_reads records of each file """
+    return [list(islice(fastqparser(open_fastq(fp)), num_reads)) for fp in fps]
+
+
+# Benchmarks, each taking the run settings and returning the number of reads and bytes it processed
+
+def bench_decompress(settings):
+    total_bytes = 0
+    for fp in settings['files']:
+        in_f = open_fastq(fp)
+        for block in iter(lambda: in_f.read(BLOCK_SIZE), ''):
+            total_bytes += len(block)
+    return settings['num_reads'], total_bytes
+
+def bench_parse(settings):
+    num_reads = 0
+    for fp in settings['files']:
+        num_reads += sum(1 for record in fastqparser(open_fastq(fp)))
+    return num_reads, sum(os.path.getsize(fp) for fp in settings['files'])
+
+def bench_header_check(settings):
+    reads1, reads2, indices = load_records(settings['files'], settings['stage_reads'])
+    start = time.time()
+    for read1, read2, index in izip(reads1, reads2, indices):
+        check_seq_headers(index[0], read1[0], read2[0])
+    return len(reads1), 0, time.time() - start
+
+def bench_match(settings):
+    indices = load_records(settings['files'][2:], settings['stage_reads'])[0]
+    barcode_to_sample_id = dict((Indices[name], name) for name in settings['indices'])
+    start = time.time()
+    barcode_lookup = build_barcode_lookup(barcode_to_sample_id, settings['max_barcode_errors'])
+    barcode_lengths = get_barcode_lengths(barcode_to_sample_id)
+    for index in indices:
+        assign_sample(index[1], None, barcode_lookup, barcode_lengths)
+    return len(indices), 0, time.time() - start
+
+def bench_format(settings):
+    reads1 = load_records(settings['files'][:1], settings['stage_reads'])[0]
+    start = time.time()
+    text = format_records(reads1)
+    return len(reads1), len(text), time.time() - start
+
+def bench_compress(settings):
+    text = format_records(load_records(settings['files'][:1], settings['stage_reads'])[0])
+    start = time.time()
+    writer = GzipWriter(os.devnull, settings['compress_level'], settings['compress_threads'])
+    for i in xrange(0, len(text), 1 << 16):
+        writer.write(text[i:i + (1 << 16)])
+    writer.close()
+    return text.count('\n') / 4, len(text), time.time() - start
+
+def bench_parse_paired_reads(settings):
+    fwd_fp, rev_fp, index_fp = settings['files']
+    writers = [GzipWriter(os.devnull, settings['compress_level'], settings['compress_threads']) for i in range(2)]
+    for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in demultiplex_reads.parse_paired_reads(
+            open_fastq(fwd_fp), open_fastq(rev_fp), open_fastq(index_fp), Indices[settings['indices'][0]], None, settings['max_barcode_errors']):
+        writers[0].write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f))
+        writers[1].write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r))
+    for writer in writers:
+        writer.close()
+    return settings['num_reads'], sum(os.path.getsize(fp) for fp in settings['files'])
+
+def keep_ids(settings):
+    return [record[0].split()[0] for record in islice(fastqparser(open_fastq(settings['files'][0])), 0, None, settings['keep_every'])]
+
+def bench_filter_paired_fastq(settings):
+    fwd_fp, rev_fp = settings['files'][:2]
+    ids = ReadIDIndex(keep_ids(settings))
+    start = time.time()
+    writers = [GzipWriter(os.devnull, settings['compress_level'], settings['compress_threads']) for i in range(2)]
+    for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in dual_fastq_filter.filter_paired_fastq(open_fastq(fwd_fp), open_fastq(rev_fp), ids):
+        writers[0].write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f))
+        writers[1].write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r))
+    for writer in writers:
+        writer.close()
+    return settings['num_reads'], sum(os.path.getsize(fp) for fp in settings['files'][:2]), time.time() - start
+
+def bench_filter_fastq(settings):
+    ids = ReadIDIndex(keep_ids(settings))
+    start = time.time()
+    fastq_filter.filter_fastq(open_fastq(settings['files'][0]), os.devnull, ids, settings['compress_level'], settings['compress_threads'])
+    return settings['num_reads'], os.path.getsize(settings['files'][0]), time.time() - start
+
+BENCHMARKS = [('decompress', bench_decompress), ('parse', bench_parse), ('header_check', bench_header_check), ('match', bench_match),
+              ('format', bench_format), ('compress', bench_compress), ('parse_paired_reads', bench_parse_paired_reads),
+              ('filter_paired_fastq', bench_filter_paired_fastq), ('filter_fastq', bench_filter_fastq)]
+
+
+def run_in_child(benchmark, settings, results_queue):
+    """ Runs a benchmark, putting (True, results) on the queue, or (False, traceback) if it raises """
+    try:
+        start = time.time()
+        result = benchmark(settings)
+        elapsed = result[2] if len(result) > 2 else time.time() - start    # Benchmarks that load data first time themselves
+        results_queue.put((True, (result[0], result[1], elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+    except Exception:
+        results_queue.put((False, traceback.format_exc()))
+
+
+def run_benchmark(benchmark, settings):
+    """ Runs a benchmark in its own process, returning its reads/s, MB/s and peak RSS.
+
+    Raises RuntimeError if the benchmark fails or its process dies without a result (e.g. killed for running out of memory).
+    """
+    results_queue = Queue()
+    child = Process(target=run_in_child, args=(benchmark, settings, results_queue))
+    child.start()
+    while True:
+        try:
+            succeeded, result = results_queue.get(timeout=1)
+            break
+        except Empty:
+            if not child.is_alive():
+                try:
+                    succeeded, result = results_queue.get(timeout=1)    # Put just before the process exited
+                    break
+                except Empty:
+                    raise RuntimeError("The benchmark process exited with status %s without a result." % child.exitcode)
+    child.join()
+    if not succeeded:
+        raise RuntimeError(result)
+    num_reads, num_bytes, elapsed, peak_rss_kb = result
+    elapsed = max(elapsed, 1e-9)
+    return {'reads': num_reads, 'bytes': num_bytes, 'seconds': round(elapsed, 4), 'reads_per_s': round(num_reads / elapsed, 1),
+            'mb_per_s': round(num_bytes / elapsed / 1e6, 2), 'peak_rss_mb': round(peak_rss_kb / 1024.0, 1)}
+
+
+def compare_results(baseline, current, tolerance):
+    """ Prints the change in reads/s of every benchmark in both results, returning the names of those that regressed """
+    regressions = []
+    print "%-20s %14s %14s %8s" % ('benchmark', 'baseline r/s', 'current r/s', 'change')
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        if 'error' in baseline['results'][name] or 'error' in current['results'][name]:
+            print "%-20s %14s %14s %8s" % (name, '', '', 'FAILED')
+            continue
+        old = baseline['results'][name]['reads_per_s']
+        new = current['results'][name]['reads_per_s']
+        change = (new - old) / old if old else 0.0
+        flag = ''
+        if change < -tolerance:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print "%-20s %14.0f %14.0f %+7.1f%% %s" % (name, old, new, 100 * change, flag)
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    if args.command == 'generate':
+        start = time.time()
+        settings = generate_run(args.output_dir, args.num_reads, args.read_length, args.indices, args.undetermined_fraction,
+                                args.error_rate, args.compress_level, args.seed)
+        json.dump(settings, open('%s/run_settings.json' % args.output_dir, 'w'), indent=2, sort_keys=True)
+        print "Generated %d read pairs in %.1f seconds" % (args.num_reads, time.time() - start)
+
+    elif args.command == 'run':
+        settings = json.load(open('%s/run_settings.json' % args.data_dir))
+        settings['files'] = run_file_names(args.data_dir, settings.pop('compress_level'))
+        settings.update({'max_barcode_errors': args.max_barcode_errors, 'keep_every': args.keep_every, 'compress_level': args.compress_level,
+                         'compress_threads': args.compress_threads, 'stage_reads': min(args.stage_reads, settings['num_reads'])})
+        results = {}
+        failed = []
+        for name, benchmark in BENCHMARKS:
+            if args.benchmarks and name not in args.benchmarks:
+                continue
+            try:
+                results[name] = run_benchmark(benchmark, settings)
+            except RuntimeError, e:
+                print >> sys.stderr, "%-20s FAILED\n%s" % (name, e)
+                results[name] = {'error': str(e)}
+                failed.append(name)
+                continue
+            print "%-20s %12.0f reads/s %8.1f MB/s %8.1f MB peak RSS" % (name, results[name]['reads_per_s'], results[name]['mb_per_s'], results[name]['peak_rss_mb'])
+        output = {'settings': settings, 'results': results, 'python': sys.version.split()[0], 'host': platform.node(),
+                  'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        json.dump(output, open(args.output, 'w'), indent=2, sort_keys=True)
+        if failed:
+            sys.exit(1)
+
+    elif args.command == 'compare':
+        if compare_results(json.load(open(args.baseline)), json.load(open(args.current)), args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Checksums of input and output files computed on the bytes that are read and written anyway, so no file is read again
+just to checksum it. Used by demultiplex_reads.py, dual_fastq_filter.py and per_sample_raw_reads.py to write an
+md5sums.txt file (which can be checked with md5sum -c) and a JSON manifest of file sizes, read counts and checksums.
+"""
+import hashlib
+import json
+import os
+
+MD5SUMS_FILE = 'md5sums.txt'
+MANIFEST_FILE = 'manifest.json'
+
+# Number of bytes read at a time when HashingFile reads the file itself
+BLOCK_SIZE = 1 << 20
+
+
+def manifest_digests(sha256=False):
+    """ Returns the names of the hashlib digests to compute for a manifest """
+    if sha256:
+        return ('md5', 'sha256')
+    return ('md5',)
+
+
+class HashingFile(object):
+    """ Wraps a binary input file, checksumming the bytes read from it.
+
+    gzip.GzipFile seeks back over the end of every gzip member and reads those bytes again, so only bytes past the
+    furthest point read so far are added to the checksums. Pipes such as stdin are only ever read forward.
+    """
+
+    def __init__(self, raw_f, digests=('md5',)):
+        self.raw_f = raw_f
+        self.hashes = [(name, hashlib.new(name)) for name in digests]
+        self.hashed = 0     # Number of bytes from the start of the file added to the checksums
+        try:
+            raw_f.tell()
+            self.seekable = True
+        except (IOError, OSError):
+            self.seekable = False
+
+    def update(self, data):
+        for name, digest in self.hashes:
+            digest.update(data)
+        self.hashed += len(data)
+
+    def read(self, size=-1):
+        if not self.seekable:
+            data = self.raw_f.read(size)
+            self.update(data)
+            return data
+        position = self.raw_f.tell()
+        if position > self.hashed:
+            # Never happens when reading through the file, but keeps the checksums right if it is seeked forward
+            self.raw_f.seek(self.hashed)
+            while self.hashed < position:
+                self.update(self.raw_f.read(min(BLOCK_SIZE, position - self.hashed)))
+        data = self.raw_f.read(size)
+        if position + len(data) > self.hashed:
+            self.update(data[self.hashed - position:])
+        return data
+
+    def __iter__(self):
+        """ Yields the lines of the file, read in large blocks """
+        leftover = ''
+        for block in iter(lambda: self.read(BLOCK_SIZE), ''):
+            lines = (leftover + block).split('\n')
+            leftover = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if leftover:
+            yield leftover
+
+    def hexdigests(self):
+        """ Returns the checksums of the whole file, reading any of it that hasn't been read yet """
+        if self.seekable:
+            position = self.raw_f.tell()
+            self.raw_f.seek(self.hashed)
+        for block in iter(lambda: self.raw_f.read(BLOCK_SIZE), ''):
+            self.update(block)
+        if self.seekable:
+            self.raw_f.seek(position)
+        return dict((name, digest.hexdigest()) for name, digest in self.hashes)
+
+    def __getattr__(self, name):
+        return getattr(self.raw_f, name)
+
+
+def output_entry(fp, writer):
+    """ Returns the manifest entry of a closed GzipWriter that was written to fp """
+    entry = {'file': fp, 'bytes': writer.size, 'reads': writer.reads}
+    entry.update(writer.hexdigests())
+    return entry
+
+
+def input_entry(fp, hashing_f):
+    """ Returns the manifest entry of an input file read through a HashingFile """
+    entry = hashing_f.hexdigests()
+    entry.update({'file': fp, 'bytes': hashing_f.hashed})
+    return entry
+
+
+def md5sum_line(entry, manifest_dir=None):
+    """ Returns the md5sum style line of a manifest entry, with the file path relative to manifest_dir if it is given """
+    if manifest_dir is None:
+        return "%s  %s" % (entry['md5'], entry['file'])
+    return "%s  %s" % (entry['md5'], os.path.relpath(entry['file'], manifest_dir))
+
+
+def write_manifest(manifest_fp, outputs, inputs=(), md5sums_fp=None):
+    """ Writes the JSON manifest of the output and input entries, and the md5sums file of the outputs """
+    manifest_dir = os.path.dirname(manifest_fp) or '.'
+    if md5sums_fp is None:
+        md5sums_fp = os.path.join(manifest_dir, MD5SUMS_FILE)
+    md5_f = open(md5sums_fp, 'w')
+    for entry in outputs:
+        if entry['file'] != '-':
+            md5_f.write(md5sum_line(entry, manifest_dir) + '\n')
+    md5_f.close()
+    manifest_f = open(manifest_fp, 'w')
+    json.dump({'outputs': list(outputs), 'inputs': list(inputs)}, manifest_f, indent=2, sort_keys=True)
+    manifest_f.write('\n')
+    manifest_f.close()
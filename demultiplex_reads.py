@@ -10,13 +10,26 @@ __credits__ = ["Created using code lifted from the QIIME project (www.qiime.org)
 """
 Demultiplex paired reads for sample MyGenome having index N701 for one MiSeq run and write results to directory GenomeA/,
 demultiplex_reads.py -f Undetermined_read1.fastq.gz -r Undetermined_read2.fastq.gz -b Undetermined_I1.fastq.gz -o GenomeA/ -i N701 -n MyGenome
+
+Demultiplex several samples in a single pass over the input files, either from SampleID/IndexName pairs or a QIIME mapping file,
+demultiplex_reads.py -f Undetermined_read1.fastq.gz -r Undetermined_read2.fastq.gz -b Undetermined_I1.fastq.gz -o Reads/ -p GenomeA N701 GenomeB N702
+demultiplex_reads.py -f Undetermined_read1.fastq.gz -r Undetermined_read2.fastq.gz -b Undetermined_I1.fastq.gz -o Reads/ -m Map.txt
 """
 import argparse
-import gzip
 import sys
 from os import rename, makedirs
 from os.path import isdir, exists
-from itertools import izip
+from bisect import bisect_left
+from itertools import izip, repeat, combinations, product
+
+from checksums import MANIFEST_FILE, input_entry, manifest_digests, output_entry, write_manifest
+from fastq_input import open_fastq
+from fastq_parser import ParseError
+from gzip_writer import COMPRESS_LEVEL, GzipWriter, fastq_extension
+from parallel_batches import format_records, map_batches, record_batches
+from read_store import ReadStore, is_read_store
+from run_checkpoint import CHECKPOINT_FILE, CHECKPOINT_READS, Checkpointer, file_signature, load_checkpoint
+from run_stats import CENSUS_SIZE, PROGRESS_READS, RunStats, TimedWriter, parse_records
 
 class MyParser(argparse.ArgumentParser):
     def error(self, message):
@@ -25,20 +38,39 @@ class MyParser(argparse.ArgumentParser):
         sys.exit(2)
 
 parser = MyParser()
-parser.add_argument('-f', '--fwd_reads', required=True, help="The Read 1 fastq file to search through. [REQUIRED]", metavar='Undetermined_R1.fastq.gz')
-parser.add_argument('-r', '--rev_reads', required=True, help="The Read 2 fastq file to search through. [REQUIRED]", metavar='Undetermined_R2.fastq.gz')
-parser.add_argument('-b', '--index_reads', required=True, help="The index fastq file to search against. [REQUIRED]", metavar='Undetermined_I1.fastq.gz')
+parser.add_argument('-f', '--fwd_reads', required=True, help="The Read 1 fastq file to search through, or a read store of the run made by read_store.py. [REQUIRED]", metavar='Undetermined_R1.fastq.gz')
+parser.add_argument('-r', '--rev_reads', required=False, help="The Read 2 fastq file to search through. [REQUIRED unless -f is a read store]", metavar='Undetermined_R2.fastq.gz')
+parser.add_argument('-b', '--index_reads', required=False, help="The index fastq file to search against. [REQUIRED unless -f is a read store]", metavar='Undetermined_I1.fastq.gz')
+parser.add_argument('-d', '--index2_reads', required=False, help="The i5 index fastq file for dual-indexed runs, with indices given as e.g. N701+S502.", metavar='Undetermined_I2.fastq.gz')
 parser.add_argument('-o', '--output_dir', required=True, help="The output directory to use, creating if not already present. [REQUIRED]", metavar='MyGenome_reads')
-parser.add_argument('-i', '--index_name', required=True, help="The Illumina name of the index sequence. [REQUIRED]", metavar='N701')
-parser.add_argument('-n', '--sample_id', required=True, help="Sample ID that should be used to name the output files. [REQUIRED]", metavar='MyGenome')
+parser.add_argument('-i', '--index_name', required=False, help="The Illumina name of the index sequence. [REQUIRED unless -p or -m is given]", metavar='N701')
+parser.add_argument('-n', '--sample_id', required=False, help="Sample ID that should be used to name the output files. [REQUIRED unless -p or -m is given]", metavar='MyGenome')
+parser.add_argument('-p', '--sample_pairs', required=False, nargs='+', help="SampleID IndexName pairs to demultiplex together in a single pass over the input files.", metavar='MyGenome N701')
+parser.add_argument('-m', '--mapping_file', required=False, help="A QIIME mapping file of SampleIDs and BarcodeSequences to demultiplex together in a single pass over the input files.", metavar='Map.txt')
+parser.add_argument('-e', '--max_barcode_errors', required=False, type=int, default=0, help="The number of mismatches (including Ns) to allow in the index read. Default: 0", metavar='0')
+parser.add_argument('-z', '--compress_level', required=False, type=int, default=COMPRESS_LEVEL, choices=range(10), help="The gzip compression level of the output files, 0 writes uncompressed fastq files. Default: %d" % COMPRESS_LEVEL, metavar='6')
+parser.add_argument('--compress_threads', required=False, type=int, default=1, help="The number of threads to compress the output files with. Default: 1", metavar='1')
+parser.add_argument('-t', '--processes', required=False, type=int, default=1, help="The number of processes to check headers, match indices and format reads with. Default: 1", metavar='1')
+parser.add_argument('--prefetch', required=False, action='store_true', help="Decompress and parse each input file on its own thread, ahead of demultiplexing. With --stats, reports which input holds the run up.")
+parser.add_argument('--decompressor', required=False, help="A command to decompress the gzip input files with instead of zlib, e.g. 'pigz -dc'. Not used for inputs checksummed for the manifest.", metavar="'gzip -dc'")
+parser.add_argument('-s', '--stats', required=False, action='store_true', help="Report progress and write run statistics and a census of unmatched indices to demultiplex_stats.json.")
+parser.add_argument('--census_size', required=False, type=int, default=CENSUS_SIZE, help="The number of unmatched index sequences to report with --stats. Default: %d" % CENSUS_SIZE, metavar='20')
+parser.add_argument('--manifest', required=False, action='store_true', help="Write md5sums.txt and a manifest.json of the sizes, read counts and checksums of the output and input files, computed while they are written and read.")
+parser.add_argument('--sha256', required=False, action='store_true', help="Add SHA-256 checksums to manifest.json, implies --manifest.")
+parser.add_argument('--manifest_dir', required=False, help="The existing directory to write md5sums.txt and manifest.json to, implies --manifest. Default: the output directory", metavar='Manifest_folder')
+parser.add_argument('--resume', required=False, action='store_true', help="Continue an interrupted run from the last checkpoint in the output directory, skipping the samples whose output files were already finished.")
+parser.add_argument('--checkpoint_reads', required=False, type=int, default=CHECKPOINT_READS, help="The number of input reads between checkpoints that --resume can continue from, 0 for none. Default: %d" % CHECKPOINT_READS, metavar='%d' % CHECKPOINT_READS)
 parser.add_argument('-c', '--custom_index', required=False, help="The sequence of a custom index primer not that is not part of the standard Illumina set.", metavar='ATCGATCG')
 parser.add_argument('-l', '--list_indices', required=False, help="Print the built-in dictionary of Illumina indices and exit.")
 
-# Defining a dict of the Illumina index sequences
-Indices = {'N701': 'TAAGGCGA', 'N702': 'CGTACTAG', 'N703': 'AGGCAGAA', 'N704': 'TCCTGAGC', 'N705': 'GGACTCCT', 'N706': 'TAGGCATG', 'N707': 'CTCTCTAC', 'N708': 'CAGAGAGG', 'N709': 'GCTACGCT', 'N710': 'CGAGGCTG', 'N711': 'AAGAGGCA', 'N712': 'GTAGAGGA', 'AD001': 'ATCACG', 'AD002': 'CGATGT', 'AD003': 'TTAGGC', 'AD004': 'TGACCA', 'AD005': 'ACAGTG', 'AD006': 'GCCAAT', 'AD007': 'CAGATC', 'AD008': 'ACTTGA', 'AD009': 'GATCAG', 'AD010': 'TAGCTT', 'AD011': 'GGCTAC', 'AD012': 'CTTGTA', 'AD013': 'AGTCAA', 'AD014': 'AGTTCC'}
+# Defining a dict of the Illumina index sequences, the S5xx i5 indices are given as they are read on the MiSeq
+Indices = {'N701': 'TAAGGCGA', 'N702': 'CGTACTAG', 'N703': 'AGGCAGAA', 'N704': 'TCCTGAGC', 'N705': 'GGACTCCT', 'N706': 'TAGGCATG', 'N707': 'CTCTCTAC', 'N708': 'CAGAGAGG', 'N709': 'GCTACGCT', 'N710': 'CGAGGCTG', 'N711': 'AAGAGGCA', 'N712': 'GTAGAGGA', 'N714': 'GCTCATGA', 'N715': 'ATCTCAGG', 'N716': 'ACTCGCTA', 'N718': 'GGAGCTAC', 'N719': 'GCGTAGTA', 'N720': 'CGGAGCCT', 'N721': 'TACGCTGC', 'N722': 'ATGCGCAG', 'N723': 'TAGCGCTC', 'N724': 'ACTGAGCG', 'N726': 'CCTAAGAC', 'N727': 'CGATCAGT', 'N728': 'TGCAGCTA', 'N729': 'TCGACGTC', 'S501': 'TAGATCGC', 'S502': 'CTCTCTAT', 'S503': 'TATCCTCT', 'S504': 'AGAGTAGA', 'S505': 'GTAAGGAG', 'S506': 'ACTGCATA', 'S507': 'AAGGAGTA', 'S508': 'CTAAGCCT', 'S510': 'CGTCTAAT', 'S511': 'TCTCTCCG', 'S513': 'TCGACTAG', 'S515': 'TTCTAGCT', 'S516': 'CCTAGAGT', 'S517': 'GCGTAAGA', 'S518': 'CTATTAAG', 'S520': 'AAGGCTAT', 'S521': 'GAGCCTTA', 'S522': 'TTATGCGA', 'AD001': 'ATCACG', 'AD002': 'CGATGT', 'AD003': 'TTAGGC', 'AD004': 'TGACCA', 'AD005': 'ACAGTG', 'AD006': 'GCCAAT', 'AD007': 'CAGATC', 'AD008': 'ACTTGA', 'AD009': 'GATCAG', 'AD010': 'TAGCTT', 'AD011': 'GGCTAC', 'AD012': 'CTTGTA', 'AD013': 'AGTCAA', 'AD014': 'AGTTCC'}
+
+# Sample ID used for the reads whose index doesn't match any of the requested samples
+UNDETERMINED_ID = 'Undetermined'
 
-class ParseError(Exception):
-    pass
+# Bases that a sequenced index can contain, N is treated as a mismatch against any index base
+BARCODE_BASES = 'ACGTN'
 
 def create_dir(dir_name, fail_on_exist=True):
     if exists(dir_name):
@@ -71,7 +103,9 @@ def check_map(infile):
 
     for line in lines:                                             # Begin iterating over lines
         line = strip_f(line)                                       # Strip out witespace and dbl quotes
-        if line.startswith('#'):                                   # If the input line begins with a hash,
+        if not line:                                               # Skip any blank lines
+            continue
+        elif line.startswith('#'):                                 # If the input line begins with a hash,
             line = line[1:]                                        # The the line data is shifted by one character to strip the hash,
             headers = line.strip().split('\t')                     # Then strip whitespaces and split on tabs, putting line contents into the header list
         else:                                                      # Else, if the line doesn't begin with a hash, it's a sample line
@@ -82,6 +116,8 @@ def check_map(infile):
 
     id_map = {}                                                     # Create an empty dictionary instance called id_map
     for curr_data in mapping_data:                                  # For eash list in mapping_data
+        if curr_data[0] in id_map:
+            raise ParseError, ("Sample %s is listed more than once in the mapping file." % curr_data[0])
         id_map[curr_data[0]] = {}                                   # Assign the first value of the list to be a key with an empty dict associated
     for value in range(len(headers)):                               # For each list in the hds list
         for curr_data in mapping_data:                              # For each list in the mapping data
@@ -89,10 +125,76 @@ def check_map(infile):
 
     barcode_to_sample_id = {}                                       # Create an empty dictionary instance
     for sample_id, sample in id_map.items():                        # For each key:value pair in the id_map
-        barcode_to_sample_id[sample['BarcodeSequence'].upper()] = sample_id
+        barcode = sample['BarcodeSequence'].upper()
+        if barcode in barcode_to_sample_id:
+            raise ParseError, ("Barcode %s is given for both sample %s and sample %s in the mapping file." % (barcode, barcode_to_sample_id[barcode], sample_id))
+        barcode_to_sample_id[barcode] = sample_id
+
+    return barcode_to_sample_id
 
+def pairs_to_barcodes(sample_pairs):
+    """ Converts a list of alternating SampleID IndexName values into a barcode to sample ID dict """
+    if len(sample_pairs) % 2 != 0:
+        raise ParseError, ("Number of SampleID IndexName arguments is not even.")
+    barcode_to_sample_id = {}
+    for sample_id, index_name in zip(sample_pairs[0::2], sample_pairs[1::2]):
+        for name in index_name.split('+'):    # Dual indices are given as i7+i5, e.g. N701+S502
+            if name not in Indices:
+                raise ParseError, ("Unknown index name %s given for sample %s." % (name, sample_id))
+        barcode = '+'.join([Indices[name] for name in index_name.split('+')])
+        if barcode in barcode_to_sample_id:
+            raise ParseError, ("Index %s was given for both sample %s and sample %s." % (index_name, barcode_to_sample_id[barcode], sample_id))
+        barcode_to_sample_id[barcode] = sample_id
     return barcode_to_sample_id
 
+def barcode_neighbours(barcode, max_errors):
+    """ Yields every sequence within max_errors substitutions of the barcode, along with its distance """
+    positions = [i for i, base in enumerate(barcode) if base != '+']    # The i7+i5 separator is never substituted
+    for errors in range(max_errors + 1):
+        for mismatch_positions in combinations(positions, errors):
+            choices = [[base for base in BARCODE_BASES if base != barcode[i]] for i in mismatch_positions]
+            for substitutions in product(*choices):
+                neighbour = list(barcode)
+                for i, base in zip(mismatch_positions, substitutions):
+                    neighbour[i] = base
+                yield ''.join(neighbour), errors
+
+def build_barcode_lookup(barcode_to_sample_id, max_errors=0):
+    """ Builds a dict from every sequence within max_errors of an index to its sample ID.
+
+    Each sequence is assigned to the sample with the closest index, sequences that are equally close to the indices
+    of two different samples are ambiguous and map to None. Reads then only need a single dict lookup.
+    """
+    barcode_lookup = {}
+    distances = {}
+    for barcode, sample_id in barcode_to_sample_id.items():
+        for neighbour, errors in barcode_neighbours(barcode, max_errors):
+            if neighbour not in barcode_lookup or errors < distances[neighbour]:
+                barcode_lookup[neighbour] = sample_id
+                distances[neighbour] = errors
+            elif errors == distances[neighbour] and barcode_lookup[neighbour] != sample_id:
+                barcode_lookup[neighbour] = None
+    return barcode_lookup
+
+def get_barcode_lengths(barcode_to_sample_id):
+    """ Returns the (i7 length, i5 length) pairs of the barcodes, longest first, with an i5 length of 0 for single indices """
+    # Indices of different lengths can be mixed (e.g. Nextera XT and TruSeq6), so the longest barcodes have to be tried first.
+    barcode_lengths = set()
+    for barcode in barcode_to_sample_id:
+        index1, _, index2 = barcode.partition('+')
+        barcode_lengths.add((len(index1), len(index2)))
+    return sorted(barcode_lengths, reverse=True)
+
+def assign_sample(index1_seq, index2_seq, barcode_lookup, barcode_lengths):
+    """ Returns the sample ID for the index read(s) of a read, None if the index is ambiguous or UNDETERMINED_ID if there's no match """
+    for index1_length, index2_length in barcode_lengths:
+        barcode = index1_seq[:index1_length]
+        if index2_length:
+            barcode = '%s+%s' % (barcode, index2_seq[:index2_length])
+        if barcode in barcode_lookup:
+            return barcode_lookup[barcode]
+    return UNDETERMINED_ID
+
 def check_seq_headers(headerr1, headerr2, headeri1):
     """ Checks that the sequence headers are all equal to each other """
     header1 = headerr1.split(':')
@@ -106,24 +208,6 @@ def check_seq_headers(headerr1, headerr2, headeri1):
             return False
     return True
 
-def fastqparser(data):
-    if type(data) == str:
-        data = open(data, 'rU')
-    line_num = -1
-    record = []
-    for line in data:
-        line_num += 1
-        if line_num == 4:
-            yield record[0][1:], record[1], record[3] # yield the sequence header without the @ symbol, the DNA seqeunce, and quality sequence as strings
-            line_num = 0
-            record = []
-        record.append(line.strip())
-    if record:
-        if record[0]:  # could be just an empty line at eof
-            yield record[0][1:], record[1], record[3]
-    if type(data) == file:
-        data.close()
-
 def format_log(input_sequence_count, sample_seq_count):
     """ Format the split libraries log """
     log_out = ["Demultiplexing results"]
@@ -131,7 +215,18 @@ def format_log(input_sequence_count, sample_seq_count):
     log_out.append("Number of seqs for sample: %d" % sample_seq_count)
     return '\n'.join(log_out)
 
-def parse_paired_reads(fastq_read1_f, fastq_read2_f, fastq_barcode_f, index, log_f):
+def format_multi_log(input_sequence_count, sample_seq_counts, ambiguous_seq_count=0):
+    """ Format the split libraries log for a multi-sample run """
+    log_out = ["Demultiplexing results"]
+    log_out.append("Total number of input sequences: %d" % input_sequence_count)
+    for sample_id in sorted(sample_seq_counts):
+        if sample_id != UNDETERMINED_ID:
+            log_out.append("Number of seqs for sample %s: %d" % (sample_id, sample_seq_counts[sample_id]))
+    log_out.append("Number of undetermined seqs: %d" % sample_seq_counts[UNDETERMINED_ID])
+    log_out.append("Number of undetermined seqs with an ambiguous index: %d" % ambiguous_seq_count)
+    return '\n'.join(log_out)
+
+def parse_paired_reads(fastq_read1_f, fastq_read2_f, fastq_barcode_f, index, log_f, max_barcode_errors=0, stats=None, checkpoints=None):
     """parses out paired sequence reads according to given index sequence """
     # Define the index positions of the header, DNA sequence, and quality sequence of the fastqparer result.
     header_index = 0
@@ -140,12 +235,22 @@ def parse_paired_reads(fastq_read1_f, fastq_read2_f, fastq_barcode_f, index, log
     sample_seq_count = 0
 
     barcode_length = len(index) # Setting length of barcode form the dict of index sequences
+    index_lookup = build_barcode_lookup({index: index}, max_barcode_errors) # Every barcode within the allowed number of errors
 
     # prep data for logging
     input_sequence_count = 0    # Keep track of how many sequences we're reading in
-    for bc_data, read1_data, read2_data in izip(fastqparser(fastq_barcode_f), fastqparser(fastq_read1_f), fastqparser(fastq_read2_f)):
+    if checkpoints is not None:
+        # Carry on from the checkpoint being resumed, the inputs are opened at the read after it
+        input_sequence_count = checkpoints.reads
+        sample_seq_count = checkpoints.state.get('sample_seq_count', 0)
+    for bc_data, read1_data, read2_data in izip(parse_records(fastq_barcode_f, stats), parse_records(fastq_read1_f, stats), parse_records(fastq_read2_f, stats)):
+        # All the reads yielded so far have been written, so this is where a checkpoint can be saved
+        if checkpoints is not None and checkpoints.due(input_sequence_count):
+            checkpoints.save(input_sequence_count, sample_seq_count=sample_seq_count)
         # The fastqparser yields three things as a list: the header w/o the @, the DNA sequence, and quality sequence
         input_sequence_count += 1
+        if stats is not None and not input_sequence_count % PROGRESS_READS:
+            stats.progress(input_sequence_count)
         # Confirm match between barcode and read headers
         if not check_seq_headers(bc_data[header_index],read1_data[header_index], read2_data[header_index]):
             raise ParseError, ("Headers of barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another.")
@@ -157,17 +262,387 @@ def parse_paired_reads(fastq_read1_f, fastq_read2_f, fastq_barcode_f, index, log
             sequence2 = read2_data[sequence_index]             # Grad the read2 sequence string
             quality1 = read1_data[quality_index]               # Grab the read1 quality string
             quality2 = read2_data[quality_index]               # Grab the read2 quality string
-            if barcode == index:
+            if barcode in index_lookup:
                 # Returns a generator of the sequence data.
                 yield header1, sequence1, quality1, header2, sequence2, quality2
                 sample_seq_count +=1
+            elif stats is not None:
+                stats.unmatched(bc_data[sequence_index])
 
+    if stats is not None:
+        stats.reads = input_sequence_count
     if log_f != None:
         log_str = format_log(input_sequence_count, sample_seq_count)
         log_f.write(log_str)
 
+def demultiplex_paired_reads(fastq_read1_f, fastq_read2_f, fastq_barcode_f, barcode_to_sample_id, log_f, max_barcode_errors=0, fastq_barcode2_f=None, stats=None,
+                             checkpoints=None):
+    """parses out paired sequence reads for every sample in a single pass, yielding the sample ID along with the reads """
+    header_index = 0
+    sequence_index = 1
+    quality_index = 2
+
+    barcode_lengths = get_barcode_lengths(barcode_to_sample_id)
+    if fastq_barcode2_f is None and barcode_lengths[0][1]:
+        raise ParseError, ("Dual indices were given but no i5 index fastq file was.")
+    barcode_lookup = build_barcode_lookup(barcode_to_sample_id, max_barcode_errors)
+    sample_seq_counts = dict.fromkeys(barcode_to_sample_id.values(), 0)
+    sample_seq_counts[UNDETERMINED_ID] = 0
+    ambiguous_seq_count = 0
+
+    if fastq_barcode2_f is None:
+        barcode2_seqs = repeat(None)
+    else:
+        barcode2_seqs = parse_records(fastq_barcode2_f, stats)
+
+    input_sequence_count = 0
+    if checkpoints is not None:
+        input_sequence_count, ambiguous_seq_count = resume_counts(checkpoints, sample_seq_counts)
+    for bc_data, bc2_data, read1_data, read2_data in izip(parse_records(fastq_barcode_f, stats), barcode2_seqs, parse_records(fastq_read1_f, stats), parse_records(fastq_read2_f, stats)):
+        if checkpoints is not None and checkpoints.due(input_sequence_count):
+            checkpoints.save(input_sequence_count, sample_seq_counts=sample_seq_counts, ambiguous_seq_count=ambiguous_seq_count)
+        input_sequence_count += 1
+        if stats is not None and not input_sequence_count % PROGRESS_READS:
+            stats.progress(input_sequence_count)
+        if not check_seq_headers(bc_data[header_index],read1_data[header_index], read2_data[header_index]):
+            raise ParseError, ("Headers of barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another.")
+        if bc2_data is not None and not check_seq_headers(bc2_data[header_index],read1_data[header_index], read2_data[header_index]):
+            raise ParseError, ("Headers of i5 barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another.")
+        sample_id = assign_sample(bc_data[sequence_index], bc2_data and bc2_data[sequence_index], barcode_lookup, barcode_lengths)
+        if sample_id is None:
+            ambiguous_seq_count += 1
+            sample_id = UNDETERMINED_ID
+        if sample_id == UNDETERMINED_ID and stats is not None:
+            stats.unmatched(unmatched_barcode(bc_data, bc2_data))
+        sample_seq_counts[sample_id] += 1
+        yield sample_id, read1_data[header_index], read1_data[sequence_index], read1_data[quality_index], read2_data[header_index], read2_data[sequence_index], read2_data[quality_index]
+
+    if stats is not None:
+        stats.reads = input_sequence_count
+    if log_f != None:
+        log_str = format_multi_log(input_sequence_count, sample_seq_counts, ambiguous_seq_count)
+        log_f.write(log_str)
+
+def resume_counts(checkpoints, sample_seq_counts):
+    """ Restores the per-sample read counts saved by the checkpoint being resumed, returning the input and ambiguous read counts """
+    for sample_id, seq_count in checkpoints.state.get('sample_seq_counts', {}).iteritems():
+        sample_seq_counts[str(sample_id)] = seq_count
+    return checkpoints.reads, checkpoints.state.get('ambiguous_seq_count', 0)
+
+def unmatched_barcode(bc_data, bc2_data):
+    """ Returns the index sequence of an unmatched read for the census, i7+i5 for dual-indexed runs """
+    if bc2_data is None:
+        return bc_data[1]
+    return '%s+%s' % (bc_data[1], bc2_data[1])
+
+# Barcode lookup of the worker processes, set up once in each process by init_demultiplex_worker
+worker_state = {}
+
+def init_demultiplex_worker(barcode_lookup, barcode_lengths, keep_undetermined=True, census=False):
+    # The lookup is built once by the parent and inherited by the forked workers, rather than rebuilt in every worker
+    worker_state['barcode_lookup'] = barcode_lookup
+    worker_state['barcode_lengths'] = barcode_lengths
+    worker_state['keep_undetermined'] = keep_undetermined
+    worker_state['census'] = census
+
+def demultiplex_batch(batch):
+    """ Demultiplexes a batch of (index, i5 index or None, read1, read2) records.
+
+    Returns a dict of sample ID to the read1 fastq text, read2 fastq text and number of reads of that sample, the number of
+    reads with an ambiguous index and a dict of the counts of unmatched index sequences (empty unless the worker takes a census).
+    Undetermined reads are only counted, not formatted, unless the worker keeps them.
+    """
+    barcode_lookup = worker_state['barcode_lookup']
+    barcode_lengths = worker_state['barcode_lengths']
+    census = worker_state['census']
+    sample_reads = {}
+    unmatched_counts = {}
+    ambiguous_seq_count = 0
+    for bc_data, bc2_data, read1_data, read2_data in batch:
+        if not check_seq_headers(bc_data[0], read1_data[0], read2_data[0]):
+            raise ParseError, ("Headers of barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another.")
+        if bc2_data is not None and not check_seq_headers(bc2_data[0], read1_data[0], read2_data[0]):
+            raise ParseError, ("Headers of i5 barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another.")
+        sample_id = assign_sample(bc_data[1], bc2_data and bc2_data[1], barcode_lookup, barcode_lengths)
+        if sample_id is None:
+            ambiguous_seq_count += 1
+            sample_id = UNDETERMINED_ID
+        if sample_id == UNDETERMINED_ID and census:
+            barcode = unmatched_barcode(bc_data, bc2_data)
+            unmatched_counts[barcode] = unmatched_counts.get(barcode, 0) + 1
+        if sample_id not in sample_reads:
+            sample_reads[sample_id] = ([], [])
+        sample_reads[sample_id][0].append(read1_data)
+        sample_reads[sample_id][1].append(read2_data)
+    formatted = {}
+    for sample_id, (reads1, reads2) in sample_reads.items():
+        if sample_id == UNDETERMINED_ID and not worker_state['keep_undetermined']:
+            formatted[sample_id] = ('', '', len(reads1))
+        else:
+            formatted[sample_id] = (format_records(reads1), format_records(reads2), len(reads1))
+    return formatted, ambiguous_seq_count, unmatched_counts
+
+def demultiplex_paired_batches(fastq_read1_f, fastq_read2_f, fastq_barcode_f, barcode_to_sample_id, log_f, max_barcode_errors=0, fastq_barcode2_f=None, processes=1,
+                               keep_undetermined=True, stats=None, checkpoints=None):
+    """ Demultiplexes every sample in batches spread over a pool of processes.
+
+    Yields the sample ID, read1 fastq text, read2 fastq text and number of reads of each sample in each batch, in input order.
+    """
+    barcode_lengths = get_barcode_lengths(barcode_to_sample_id)
+    if fastq_barcode2_f is None and barcode_lengths[0][1]:
+        raise ParseError, ("Dual indices were given but no i5 index fastq file was.")
+    barcode_lookup = build_barcode_lookup(barcode_to_sample_id, max_barcode_errors)
+    if fastq_barcode2_f is None:
+        barcode2_seqs = repeat(None)
+    else:
+        barcode2_seqs = parse_records(fastq_barcode2_f, stats)
+    sample_seq_counts = dict.fromkeys(barcode_to_sample_id.values(), 0)
+    sample_seq_counts[UNDETERMINED_ID] = 0
+    ambiguous_seq_count = 0
+    input_sequence_count = 0
+    if checkpoints is not None:
+        input_sequence_count, ambiguous_seq_count = resume_counts(checkpoints, sample_seq_counts)
+
+    batches = record_batches([parse_records(fastq_barcode_f, stats), barcode2_seqs, parse_records(fastq_read1_f, stats), parse_records(fastq_read2_f, stats)])
+    for sample_reads, batch_ambiguous_count, unmatched_counts in map_batches(demultiplex_batch, batches, processes, init_demultiplex_worker,
+                                                                             (barcode_lookup, barcode_lengths, keep_undetermined, stats is not None)):
+        ambiguous_seq_count += batch_ambiguous_count
+        input_sequence_count += sum([seq_count for reads1, reads2, seq_count in sample_reads.values()])
+        if stats is not None:
+            stats.progress(input_sequence_count)
+            for barcode, count in unmatched_counts.iteritems():
+                stats.unmatched(barcode, count)
+        for sample_id in sorted(sample_reads):
+            reads1, reads2, seq_count = sample_reads[sample_id]
+            sample_seq_counts[sample_id] += seq_count
+            yield sample_id, reads1, reads2, seq_count
+        # The whole batch has been written
+        if checkpoints is not None and checkpoints.due(input_sequence_count):
+            checkpoints.save(input_sequence_count, sample_seq_counts=sample_seq_counts, ambiguous_seq_count=ambiguous_seq_count)
+
+    if stats is not None:
+        stats.reads = sum(sample_seq_counts.values())
+    if log_f != None:
+        log_str = format_multi_log(sum(sample_seq_counts.values()), sample_seq_counts, ambiguous_seq_count)
+        log_f.write(log_str)
+
+def demultiplex_store(store, barcode_to_sample_id, log_f, max_barcode_errors=0, keep_undetermined=True, stats=None, checkpoints=None):
+    """ Demultiplexes the reads of a read store made by read_store.py a chunk at a time, yielding like demultiplex_paired_batches.
+
+    The index column of each chunk is grouped by sample, looking up each distinct index sequence once, and only the reads
+    that are written out are decoded. Checkpoints are taken at chunk boundaries, so a resumed run starts at a chunk.
+    """
+    barcode_lengths = get_barcode_lengths(barcode_to_sample_id)
+    if 'I1' not in store.index_reads or 'R2' not in store.reads_in_pair:
+        raise ParseError, ("The read store %s has no reverse or index reads to demultiplex." % store.name)
+    if barcode_lengths[0][1] and 'I2' not in store.index_reads:
+        raise ParseError, ("Dual indices were given but the read store has no i5 index reads.")
+    barcode_lookup = build_barcode_lookup(barcode_to_sample_id, max_barcode_errors)
+    classify = lambda index: assign_sample(index.partition('+')[0], index.partition('+')[2], barcode_lookup, barcode_lengths)
+    sample_seq_counts = dict.fromkeys(barcode_to_sample_id.values(), 0)
+    sample_seq_counts[UNDETERMINED_ID] = 0
+    ambiguous_seq_count = 0
+    input_sequence_count = 0
+    first_chunk = 0
+    if checkpoints is not None:
+        input_sequence_count, ambiguous_seq_count = resume_counts(checkpoints, sample_seq_counts)
+        first_chunk = bisect_left(store.chunk_starts, input_sequence_count)
+        if input_sequence_count and (first_chunk == len(store.chunk_starts) or store.chunk_starts[first_chunk] != input_sequence_count):
+            raise ParseError, ("The checkpoint doesn't fall on a chunk of the read store, it has changed since the checkpoint.")
+
+    for chunk_num in xrange(first_chunk, len(store.chunks)):
+        groups, index_counts = store.index_groups(chunk_num, classify)
+        if None in groups:
+            ambiguous_seq_count += len(groups[None])
+            groups[UNDETERMINED_ID] = sorted(groups.pop(None) + groups.get(UNDETERMINED_ID, []))
+        input_sequence_count += store.chunks[chunk_num]['reads']
+        if stats is not None:
+            stats.progress(input_sequence_count)
+            for index, sample_id, count in index_counts:
+                if sample_id in (None, UNDETERMINED_ID):
+                    stats.unmatched(index, count)
+        for sample_id in sorted(groups):
+            offsets = groups[sample_id]
+            sample_seq_counts[sample_id] += len(offsets)
+            if sample_id == UNDETERMINED_ID and not keep_undetermined:
+                yield sample_id, '', '', len(offsets)
+            else:
+                yield sample_id, format_records(store.chunk_records(chunk_num, 'R1', offsets)), format_records(store.chunk_records(chunk_num, 'R2', offsets)), len(offsets)
+        # The whole chunk has been written
+        if checkpoints is not None and checkpoints.due(input_sequence_count):
+            checkpoints.save(input_sequence_count, sample_seq_counts=sample_seq_counts, ambiguous_seq_count=ambiguous_seq_count)
+
+    if stats is not None:
+        stats.reads = input_sequence_count
+    if log_f != None:
+        log_str = format_multi_log(input_sequence_count, sample_seq_counts, ambiguous_seq_count)
+        log_f.write(log_str)
+
+def open_reads(reads_fp, hashed_inputs=None, digests=('md5',), prefetch=False, decompressor=None, checkpoints=None):
+    """ Opens a plain or gzip compressed fastq file for reading, see fastq_input.open_fastq.
+
+    If hashed_inputs is a list, the file is checksummed as it is read and (reads_fp, HashingFile) is added to the list.
+    With checkpoints, reading starts at the read after the checkpoint being resumed, if there is one.
+    """
+    position = None
+    if checkpoints is not None:
+        position = checkpoints.input_position(reads_fp)
+    if hashed_inputs is None:
+        return open_fastq(reads_fp, prefetch=prefetch, decompressor=decompressor, position=position)
+    reads_f = open_fastq(reads_fp, digests, prefetch=prefetch, position=position)
+    hashed_inputs.append((reads_fp, reads_f.hashing_f))
+    return reads_f
+
+def write_output_manifest(manifest_dir, output_fps, hashed_inputs):
+    """ Writes md5sums.txt and manifest.json for the closed (output filepath, GzipWriter) pairs and checksummed inputs """
+    outputs = [output_entry(fp, writer) for fp, writer in output_fps]
+    inputs = [input_entry(fp, hashing_f) for fp, hashing_f in hashed_inputs]
+    write_manifest('%s/%s' % (manifest_dir, MANIFEST_FILE), outputs, inputs)
+
+def completed_samples(output_dir, sample_ids, compress_level):
+    """ Returns the sample IDs whose R1 and R2 output files were finished by an earlier run """
+    output_ext = fastq_extension(compress_level)
+    return set([sample_id for sample_id in sample_ids
+                if all([exists("%s/%s_%s%s" % (output_dir, sample_id, read, output_ext)) for read in ('R1', 'R2')])])
+
+def run_checkpointer(opts, output_dir, settings):
+    """ Returns the Checkpointer of a run, loaded from the checkpoint in output_dir if the run is resumed """
+    input_fps = [fp for fp in (opts.fwd_reads, opts.rev_reads, opts.index_reads, opts.index2_reads) if fp]
+    settings.update({'inputs': [file_signature(fp) for fp in input_fps], 'max_barcode_errors': opts.max_barcode_errors,
+                     'compress_level': opts.compress_level})
+    checkpoint_fp = '%s/%s' % (output_dir, CHECKPOINT_FILE)
+    state = None
+    if opts.resume:
+        try:
+            state = load_checkpoint(checkpoint_fp, settings)
+        except ValueError, e:
+            parser.error(str(e))
+    checkpoints = Checkpointer(checkpoint_fp, settings, opts.checkpoint_reads, state)
+    if state is None:
+        checkpoints.finish()    # A checkpoint left by an earlier run doesn't describe the files this run starts afresh
+    return checkpoints
+
+def demultiplex_multi(opts):
+    """ Demultiplexes all samples from a list of pairs or a mapping file in a single pass """
+    try:
+        if opts.mapping_file:
+            barcode_to_sample_id = check_map(opts.mapping_file)
+        else:
+            barcode_to_sample_id = pairs_to_barcodes(opts.sample_pairs)
+    except ParseError, e:
+        parser.error(str(e))
+    if UNDETERMINED_ID in barcode_to_sample_id.values():
+        parser.error("%s can't be used as a sample ID, it names the output files of the reads that match no sample." % UNDETERMINED_ID)
+    output_dir = opts.output_dir
+    create_dir(output_dir, fail_on_exist=False)
+
+    # One pair of gzip writers per sample, plus the undetermined bucket
+    sample_ids = sorted(set(barcode_to_sample_id.values())) + [UNDETERMINED_ID]
+    skipped = set()
+    if opts.resume:
+        skipped = completed_samples(output_dir, sample_ids, opts.compress_level)
+        if skipped:
+            print >> sys.stderr, "Skipping the samples already finished: %s" % ', '.join(sorted(skipped))
+    checkpoints = run_checkpointer(opts, output_dir, {'samples': barcode_to_sample_id})
+    if len(skipped) == len(sample_ids):
+        checkpoints.finish()
+        return
+    digests = manifest_digests(opts.sha256) if opts.manifest else ()
+    hashed_inputs = [] if opts.manifest else None
+    writers = {}
+    for sample_id in sample_ids:
+        if sample_id in skipped:
+            continue
+        output_fps = ["%s/%s_%s.fastq.incomplete" % (output_dir, sample_id, read) for read in ('R1', 'R2')]
+        try:
+            resume_points = [checkpoints.output_start(output_fp) for output_fp in output_fps]
+        except ValueError, e:
+            parser.error(str(e))
+        writers[sample_id] = tuple([GzipWriter(output_fp, opts.compress_level, opts.compress_threads, digests=digests, resume_from=resume_from)
+                                    for output_fp, resume_from in zip(output_fps, resume_points)])
+        for output_fp, writer in zip(output_fps, writers[sample_id]):
+            checkpoints.add_output(output_fp, writer)
+    output_fs = dict(writers)
+    log_f = open('%s/demultiplex_log.txt' % output_dir, 'w')
+
+    store = None
+    if is_read_store(opts.fwd_reads):
+        store = barcode_read_f = ReadStore(opts.fwd_reads)
+    else:
+        fwd_read_f = open_reads(opts.fwd_reads, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
+        rev_read_f = open_reads(opts.rev_reads, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
+        barcode_read_f = open_reads(opts.index_reads, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
+        if opts.index2_reads:
+            barcode2_read_f = open_reads(opts.index2_reads, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
+        else:
+            barcode2_read_f = None
+    stats = None
+    if opts.stats:
+        stats = RunStats(barcode_read_f, opts.census_size)
+        stats.resume(checkpoints.reads)
+        for sample_id in writers:
+            output_fs[sample_id] = tuple([TimedWriter(output_f, stats) for output_f in output_fs[sample_id]])
+    sample_seq_counts = dict.fromkeys(sample_ids, 0)
+    resume_counts(checkpoints, sample_seq_counts)
+    if store is not None or opts.processes > 1:
+        if store is not None:
+            batch_generator = demultiplex_store(store, barcode_to_sample_id, log_f, opts.max_barcode_errors, stats=stats, checkpoints=checkpoints)
+        else:
+            batch_generator = demultiplex_paired_batches(fwd_read_f, rev_read_f, barcode_read_f, barcode_to_sample_id, log_f,
+                                                         opts.max_barcode_errors, barcode2_read_f, opts.processes, stats=stats, checkpoints=checkpoints)
+        for sample_id, reads1, reads2, seq_count in batch_generator:
+            sample_seq_counts[sample_id] += seq_count
+            if sample_id in skipped:
+                continue
+            output_r1_f, output_r2_f = output_fs[sample_id]
+            output_r1_f.write(reads1)
+            output_r2_f.write(reads2)
+    else:
+        seq_generator = demultiplex_paired_reads(fwd_read_f, rev_read_f, barcode_read_f, barcode_to_sample_id, log_f,
+                                                 opts.max_barcode_errors, barcode2_read_f, stats, checkpoints)
+        for sample_id, header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in seq_generator:
+            sample_seq_counts[sample_id] += 1
+            if sample_id in skipped:
+                continue
+            output_r1_f, output_r2_f = output_fs[sample_id]
+            output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f))
+            output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r))
+
+    log_f.write('\n---\n\n')
+    log_f.close()
+
+    output_fps = []
+    for sample_id in sample_ids:
+        if sample_id in skipped:
+            continue
+        for output_f, writer, read in zip(output_fs[sample_id], writers[sample_id], ('R1', 'R2')):
+            output_f.close()
+            output_fp = "%s/%s_%s%s" % (output_dir, sample_id, read, fastq_extension(opts.compress_level))
+            rename("%s/%s_%s.fastq.incomplete" % (output_dir, sample_id, read), output_fp)
+            output_fps.append((output_fp, writer))
+    checkpoints.finish()
+    if hashed_inputs is not None:
+        write_output_manifest(opts.manifest_dir or output_dir, output_fps, hashed_inputs)
+    if stats is not None:
+        stats.write_json('%s/demultiplex_stats.json' % output_dir, sample_reads=sample_seq_counts)
+
 def main():
     opts = parser.parse_args()
+    opts.manifest = opts.manifest or opts.sha256 or opts.manifest_dir is not None
+    if opts.manifest_dir is not None and not isdir(opts.manifest_dir):
+        parser.error("The manifest directory %s doesn't exist." % opts.manifest_dir)    # Checked now rather than after all the reads are written
+    if is_read_store(opts.fwd_reads):
+        if opts.rev_reads or opts.index_reads or opts.index2_reads:
+            parser.error("-r, -b and -d can't be used with a read store, which holds the reverse and index reads itself.")
+    elif not opts.rev_reads or not opts.index_reads:
+        parser.error("-r and -b are required unless -f is a read store made by read_store.py.")
+    if opts.sample_pairs or opts.mapping_file:
+        demultiplex_multi(opts)
+        return
+    if not opts.index_name or not opts.sample_id:
+        parser.error("Either -i and -n, or one of -p or -m, must be given.")
+    if opts.index2_reads:
+        parser.error("Dual indices (-d) can only be used with -p or -m.")
     fwd_reads_fp = opts.fwd_reads                                           # Set the input R1 filepath
     rev_reads_fp = opts.rev_reads                                           # Set the input R2 filepath
     index_read_fp = opts.index_reads                                        # Set the index read filepath
@@ -177,35 +652,71 @@ def main():
     create_dir(output_dir)                                                  # Create the output directory safely
     output_r1_fp_temp = "%s/%s_R1.fastq.incomplete" % (output_dir,sample)   # Set the name and filepath of the temporary output R1 file
     output_r2_fp_temp = "%s/%s_R2.fastq.incomplete" % (output_dir,sample)   # Set the name and filepath of the temporary output R2 file
-    output_r1_fp = '%s/%s_R1.fastq.gz' % (output_dir, sample)               # Set the name and filepath of the actual output R1 file
-    output_r2_fp = '%s/%s_R2.fastq.gz' % (output_dir, sample)               # Set the name and filepath of the actual output R2 file
-    output_r1_f = gzip.open(output_r1_fp_temp,'w')                          # Going to automatically write to gzip compressed file.
-    output_r2_f = gzip.open(output_r2_fp_temp,'w')                          # Going to automatically write to gzip compressed file.
+    output_ext = fastq_extension(opts.compress_level)                       # Output is gzip compressed unless the compression level is 0
+    output_r1_fp = '%s/%s_R1%s' % (output_dir, sample, output_ext)          # Set the name and filepath of the actual output R1 file
+    output_r2_fp = '%s/%s_R2%s' % (output_dir, sample, output_ext)          # Set the name and filepath of the actual output R2 file
+    checkpoints = run_checkpointer(opts, output_dir, {'index': barcode, 'sample': sample, 'batched': opts.processes > 1})
+    if opts.resume and completed_samples(output_dir, [sample], opts.compress_level):
+        print >> sys.stderr, "Sample %s is already finished." % sample
+        checkpoints.finish()
+        return
+    digests = manifest_digests(opts.sha256) if opts.manifest else ()
+    hashed_inputs = [] if opts.manifest else None                          # Inputs are checksummed as they are read for the manifest
+    try:
+        resume_r1, resume_r2 = checkpoints.output_start(output_r1_fp_temp), checkpoints.output_start(output_r2_fp_temp)
+    except ValueError, e:
+        parser.error(str(e))
+    output_r1_f = GzipWriter(output_r1_fp_temp, opts.compress_level, opts.compress_threads, digests=digests, resume_from=resume_r1)
+    output_r2_f = GzipWriter(output_r2_fp_temp, opts.compress_level, opts.compress_threads, digests=digests, resume_from=resume_r2)
+    checkpoints.add_output(output_r1_fp_temp, output_r1_f)
+    checkpoints.add_output(output_r2_fp_temp, output_r2_f)
+    writers = [(output_r1_fp, output_r1_f), (output_r2_fp, output_r2_f)]
     log_fp = '%s/demultiplex_log.txt' % output_dir                          # Set the name and filepath of the log file
     log_f = open(log_fp,'w')                                                # Writing the log file as plain text (no compression).
 
 
-    # Check file extensions of read and index files to determine which method to use for opening file for processing
-    if fwd_reads_fp.endswith('.gz'):            # If the input read file is gzipped ## sequence_read_fp == fwd_reads_fp
-        fwd_read_f = gzip.open(fwd_reads_fp)    # Then gzopen it for reading
-    else:                                       # Else
-        fwd_read_f = open(fwd_reads_fp,'U')     # Open as a standard text file
-    if rev_reads_fp.endswith('.gz'):
-        rev_read_f = gzip.open(rev_reads_fp)
-    else:
-        rev_read_f = open(rev_reads_fp,'U')
-    if index_read_fp.endswith('.gz'):
-        barcode_read_f = gzip.open(index_read_fp)
+    # Open the read and index files, plain or gzip compressed, or the read store holding all three
+    store = None
+    if is_read_store(fwd_reads_fp):
+        store = barcode_read_f = ReadStore(fwd_reads_fp)
     else:
-        barcode_read_f = open(index_read_fp,'U')
+        fwd_read_f = open_reads(fwd_reads_fp, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
+        rev_read_f = open_reads(rev_reads_fp, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
+        barcode_read_f = open_reads(index_read_fp, hashed_inputs, digests, opts.prefetch, opts.decompressor, checkpoints)
 
-    # Parse reads and return to a generator expression to reduce memory footprint:
-    seq_generator = parse_paired_reads(fwd_read_f, rev_read_f, barcode_read_f, barcode, log_f)
+    stats = None
+    if opts.stats:
+        stats = RunStats(barcode_read_f, opts.census_size)
+        stats.resume(checkpoints.reads)
+        output_r1_f = TimedWriter(output_r1_f, stats)
+        output_r2_f = TimedWriter(output_r2_f, stats)
+    sample_seq_count = output_r1_f.reads                                    # Reads written before the checkpoint being resumed, if any
+    if store is not None or opts.processes > 1:
+        # Demultiplex in batches over several processes, or in chunks of the read store, keeping only the reads of the sample
+        input_sequence_count = checkpoints.reads
+        if store is not None:
+            batch_generator = demultiplex_store(store, {barcode: sample}, None, opts.max_barcode_errors, keep_undetermined=False, stats=stats,
+                                                checkpoints=checkpoints)
+        else:
+            batch_generator = demultiplex_paired_batches(fwd_read_f, rev_read_f, barcode_read_f, {barcode: sample}, None,
+                                                         opts.max_barcode_errors, processes=opts.processes, keep_undetermined=False, stats=stats,
+                                                         checkpoints=checkpoints)
+        for sample_id, reads1, reads2, seq_count in batch_generator:
+            input_sequence_count += seq_count
+            if sample_id == sample:
+                output_r1_f.write(reads1)
+                output_r2_f.write(reads2)
+                sample_seq_count += seq_count
+        log_f.write(format_log(input_sequence_count, sample_seq_count))
+    else:
+        # Parse reads and return to a generator expression to reduce memory footprint:
+        seq_generator = parse_paired_reads(fwd_read_f, rev_read_f, barcode_read_f, barcode, log_f, opts.max_barcode_errors, stats, checkpoints)
 
-    # Write the parsed data to both output files
-    for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in seq_generator:
-        output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f)) # This will write out fastq output
-        output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r)) # This will write out fastq output
+        # Write the parsed data to both output files
+        for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in seq_generator:
+            sample_seq_count += 1
+            output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f)) # This will write out fastq output
+            output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r)) # This will write out fastq output
 
     log_f.write('\n---\n\n')
 
@@ -213,6 +724,11 @@ def main():
     rename(output_r1_fp_temp, output_r1_fp)
     output_r2_f.close()
     rename(output_r2_fp_temp, output_r2_fp)
+    checkpoints.finish()
+    if hashed_inputs is not None:
+        write_output_manifest(opts.manifest_dir or output_dir, writers, hashed_inputs)
+    if stats is not None:
+        stats.write_json('%s/demultiplex_stats.json' % output_dir, sample_reads={sample: sample_seq_count})
 
 if __name__ == "__main__":
     main()
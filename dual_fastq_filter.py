@@ -9,19 +9,35 @@ __version__ = "1.0"
 __revised__ = "2015-03-29"
 
 import argparse
-import gzip
+import os
 from itertools import izip
 
-class ParseError(Exception):
-    pass
+from fastq_parser import ParseError
+from checksums import MANIFEST_FILE, input_entry, manifest_digests, output_entry, write_manifest
+from fastq_input import open_fastq
+from fastq_offset_index import indexed_records, load_offset_index
+from gzip_writer import COMPRESS_LEVEL, GzipWriter, output_fastq_name
+from parallel_batches import format_records, map_batches, record_batches
+from read_id_index import ReadIDIndex, load_read_ids
+from read_store import ReadStore, is_read_store
+from run_stats import PROGRESS_READS, RunStats, TimedWriter, count_batches, count_records, parse_records
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-f', '--forward', required=True, help="The forward input fastq file to search through. [REQUIRED]", metavar='Input1.fastq')
-parser.add_argument('-r', '--reverse', required=True, help="The reverse input fastq file to search through. [REQUIRED]", metavar='Input2.fastq')
-parser.add_argument('-o', '--output1', required=True, help="The output fastq to create. [REQUIRED]", metavar='Output1.fastq.gz')
-parser.add_argument('-p', '--output2', required=True, help="The output fastq to create. [REQUIRED]", metavar='Output2.fastq.gz')
-parser.add_argument('-n', '--names', required=True, help="The file containing the read IDs to search for. [REQUIRED]", metavar='Names.txt')
-args = parser.parse_args()
+parser.add_argument('-f', '--forward', required=True, help="The forward input fastq file to search through, plain or gzip compressed, or - for stdin, or a read store of both reads made by read_store.py. [REQUIRED]", metavar='Input1.fastq')
+parser.add_argument('-r', '--reverse', required=False, help="The reverse input fastq file to search through, plain or gzip compressed, or - for stdin. [REQUIRED unless -f is a read store]", metavar='Input2.fastq')
+parser.add_argument('-o', '--output1', required=True, help="The output fastq to create, or - for stdout. [REQUIRED]", metavar='Output1.fastq.gz')
+parser.add_argument('-p', '--output2', required=True, help="The output fastq to create, or - for stdout. [REQUIRED]", metavar='Output2.fastq.gz')
+parser.add_argument('-z', '--compress_level', required=False, type=int, default=COMPRESS_LEVEL, choices=range(10), help="The gzip compression level of the output files, 0 writes uncompressed fastq files. Default: %d" % COMPRESS_LEVEL, metavar='6')
+parser.add_argument('--compress_threads', required=False, type=int, default=1, help="The number of threads to compress the output files with. Default: 1", metavar='1')
+parser.add_argument('-t', '--processes', required=False, type=int, default=1, help="The number of processes to check headers and filter reads with. Default: 1", metavar='1')
+parser.add_argument('-n', '--names', required=True, help="The file containing the read IDs to search for, or a read ID index created by read_id_index.py. [REQUIRED]", metavar='Names.txt')
+parser.add_argument('--no_index', required=False, action='store_true', help="Scan the whole input files even if they have offset indexes made by fastq_offset_index.py.")
+parser.add_argument('--prefetch', required=False, action='store_true', help="Decompress and parse each input file on its own thread, ahead of filtering. With --stats, reports which input holds the run up.")
+parser.add_argument('--decompressor', required=False, help="A command to decompress the gzip input files with instead of zlib, e.g. 'pigz -dc'. Not used for inputs checksummed for the manifest.", metavar="'gzip -dc'")
+parser.add_argument('--manifest', required=False, action='store_true', help="Write md5sums.txt and a manifest.json of the sizes, read counts and checksums of the output and input files, computed while they are written and read.")
+parser.add_argument('--sha256', required=False, action='store_true', help="Add SHA-256 checksums to manifest.json, implies --manifest.")
+parser.add_argument('--manifest_dir', required=False, help="The existing directory to write md5sums.txt and manifest.json to, implies --manifest. Default: the directory of the -o output file", metavar='Manifest_folder')
+parser.add_argument('-s', '--stats', required=False, help="Report progress and write run statistics to this JSON file.", metavar='stats.json')
 
 def check_seq_headers(headerr1, headerr2):
     """ Checks that the sequence headers are all equal to each other """
@@ -33,29 +49,15 @@ def check_seq_headers(headerr1, headerr2):
     return True
 
 
-def fastqparser(data):
-    if type(data) == str:
-        data = open(data, 'rU')
-    line_num = -1
-    record = []
-    for line in data:
-        line_num += 1
-        if line_num == 4:
-            yield record[0][1:], record[1], record[3]
-            line_num = 0
-            record = []
-        record.append(line.strip())
-    if record:
-        if record[0]:  # could be just an empty line at eof
-            yield record[0][1:], record[1], record[3]
-    if type(data) == file:
-        data.close()
-
-
-def filter_paired_fastq(fastq_read1_f, fastq_read2_f, seqs_to_keep):
-    # seqs_to_keep_lookup = {}.fromkeys([seq_id.split()[0] for seq_id in seqs_to_keep])
-
-    for read1_data, read2_data in izip(fastqparser(fastq_read1_f), fastqparser(fastq_read2_f)):
+def filter_paired_fastq(fastq_read1_f, fastq_read2_f, seqs_to_keep, stats=None):
+    if not isinstance(seqs_to_keep, (ReadIDIndex, set, frozenset, dict)):
+        seqs_to_keep = ReadIDIndex(seqs_to_keep)    # Membership tests on a list are far too slow for large ID lists
+
+    input_sequence_count = 0
+    for read1_data, read2_data in izip(parse_records(fastq_read1_f, stats), parse_records(fastq_read2_f, stats)):
+        input_sequence_count += 1
+        if stats is not None and not input_sequence_count % PROGRESS_READS:
+            stats.progress(input_sequence_count)
         if not check_seq_headers(read1_data[0], read2_data[0]):
             raise ParseError, "Headers of barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another."
         else:
@@ -67,45 +69,142 @@ def filter_paired_fastq(fastq_read1_f, fastq_read2_f, seqs_to_keep):
             qual2 = read2_data[2]
             if header1.split()[0] in seqs_to_keep:
                 yield header1, seq1, qual1, header2, seq2,qual2
+    if stats is not None:
+        stats.reads = input_sequence_count
+
+
+def indexed_pairs(fwd_reads_fp, rev_reads_fp, seqs_to_keep, stats=None):
+    """ Returns the wanted pairs read through the offset indexes of both files, or None if either has no usable index """
+    index1 = load_offset_index(fwd_reads_fp)
+    index2 = load_offset_index(rev_reads_fp)
+    if index1 is None or index2 is None:
+        return None
+    reads1 = indexed_records(fwd_reads_fp, index1, seqs_to_keep)
+    reads2 = indexed_records(rev_reads_fp, index2, seqs_to_keep)
+    if reads1 is None or reads2 is None:
+        return None
+    if stats is not None:
+        return count_records(filter_indexed_pairs(reads1, reads2), stats)     # Only the wanted pairs are read
+    return filter_indexed_pairs(reads1, reads2)
+
+def filter_indexed_pairs(reads1, reads2):
+    """ Yields the pairs of records read through the offset indexes, checking that they still belong together """
+    for read1_data, read2_data in izip(reads1, reads2):
+        if not check_seq_headers(read1_data[0], read2_data[0]):
+            raise ParseError, "Headers of the indexed reads do not match. Confirm that the read1 and read2 fastq files match one another and that their indexes are up to date."
+        yield read1_data + read2_data
+
+
+# Read IDs to keep in the worker processes, set up once in each process by init_filter_worker
+worker_state = {}
+
+def init_filter_worker(seqs_to_keep):
+    worker_state['seqs_to_keep'] = seqs_to_keep
+
+def filter_batch(batch):
+    """ Filters a batch of (read1, read2) records, returning the read1 fastq text, read2 fastq text and number of pairs kept """
+    seqs_to_keep = worker_state['seqs_to_keep']
+    reads1 = []
+    reads2 = []
+    for read1_data, read2_data in batch:
+        if not check_seq_headers(read1_data[0], read2_data[0]):
+            raise ParseError, "Headers of barcode and read do not match. Can't continue. Confirm that the barcode fastq and read fastq that you are passing match one another."
+        if read1_data[0].split()[0] in seqs_to_keep:
+            reads1.append(read1_data)
+            reads2.append(read2_data)
+    return format_records(reads1), format_records(reads2), len(reads1)
+
+
+def filter_paired_batches(fastq_read1_f, fastq_read2_f, seqs_to_keep, processes=1, stats=None):
+    """ Filters paired reads in batches spread over a pool of processes, yielding the fastq text of each batch in input order """
+    if not isinstance(seqs_to_keep, (ReadIDIndex, set, frozenset, dict)):
+        seqs_to_keep = ReadIDIndex(seqs_to_keep)
+    batches = record_batches([parse_records(fastq_read1_f, stats), parse_records(fastq_read2_f, stats)])
+    if stats is not None:
+        batches = count_batches(batches, stats)
+    for reads1, reads2, seq_count in map_batches(filter_batch, batches, processes, init_filter_worker, (seqs_to_keep,)):
+        yield reads1, reads2
 
 
 def main():
+    args = parser.parse_args()
     fwd_reads_fp = args.forward
     rev_reads_fp = args.reverse
     output_r1 = args.output1
     output_r2 = args.output2
-    output_r1_f = gzip.open(output_r1,'w')      # Going to automatically write to gzip compressed file.
-    output_r2_f = gzip.open(output_r2,'w')      # Going to automatically write to gzip compressed file.
-
-    if output_r1.endswith('.fastq'):
-        print "Warning: Output files are automatically gzip compressed, adding correct extension to output file name."
-        output_r1 += '.gz'
-    if output_r2.endswith('.fastq'):
-        print "Warning: Output files are automatically gzip compressed, adding correct extension to output file name."
-        output_r2 += '.gz'
+    if output_r1 == '-' and output_r2 == '-':
+        parser.error("Only one of the output files can be written to stdout.")
+    if fwd_reads_fp == '-' and rev_reads_fp == '-':
+        parser.error("Only one of the input files can be read from stdin.")
+    store = None
+    if is_read_store(fwd_reads_fp):
+        store = ReadStore(fwd_reads_fp)
+        if 'R2' not in store.reads_in_pair:
+            parser.error("The read store %s has no reverse reads." % fwd_reads_fp)
+    elif rev_reads_fp is None:
+        parser.error("-r is required unless -f is a read store made by read_store.py.")
+    args.manifest = args.manifest or args.sha256 or args.manifest_dir is not None
+    manifest_dir = args.manifest_dir
+    if manifest_dir is None:
+        manifest_dir = os.path.dirname(output_r1 if output_r1 != '-' else output_r2) or '.'
+    if args.manifest and not os.path.isdir(manifest_dir):
+        parser.error("The manifest directory %s doesn't exist." % manifest_dir)     # Checked now rather than after all the reads are filtered
+    digests = manifest_digests(args.sha256) if args.manifest else ()
+
+    output_r1 = output_fastq_name(output_r1, args.compress_level)      # .gz only if the outputs are gzip compressed
+    output_r2 = output_fastq_name(output_r2, args.compress_level)
+    output_r1_f = GzipWriter(output_r1, args.compress_level, args.compress_threads, digests=digests)      # Going to automatically write to gzip compressed file.
+    output_r2_f = GzipWriter(output_r2, args.compress_level, args.compress_threads, digests=digests)      # Going to automatically write to gzip compressed file.
+    writers = [(output_r1, output_r1_f), (output_r2, output_r2_f)]
     NAMES = args.names
-    keep_IDs = list([l.split()[0].strip() for l in open(NAMES, 'U')]) # Creates a list of seqIDs for seqs we want to keep
-
-    # Check file extensions of read and index files to determine which method to use for opening file for processing
-    if fwd_reads_fp.endswith('.gz'):            # If the input read file is gzipped ## sequence_read_fp == fwd_reads_fp
-        fwd_read_f = gzip.open(fwd_reads_fp)    # Then gzopen it for reading
-    else:                                       # Else
-        fwd_read_f = open(fwd_reads_fp,'U')     # Open as a standard text file
-    if rev_reads_fp.endswith('.gz'):
-        rev_read_f = gzip.open(rev_reads_fp)
+    keep_IDs = load_read_ids(NAMES) # Creates an index of seqIDs for seqs we want to keep
+
+    # Inputs can be plain or gzip compressed fastq, or stdin, and are checksummed on the bytes read for the manifest
+    hashed_inputs = []
+    if store is None:
+        fwd_read_f = open_fastq(fwd_reads_fp, digests, prefetch=args.prefetch, decompressor=args.decompressor)
+        rev_read_f = open_fastq(rev_reads_fp, digests, prefetch=args.prefetch, decompressor=args.decompressor)
+        if args.manifest:
+            hashed_inputs = [(fwd_reads_fp, fwd_read_f.hashing_f), (rev_reads_fp, rev_read_f.hashing_f)]
+
+    stats = None
+    if args.stats:
+        stats = RunStats(store if store is not None else fwd_read_f)
+        output_r1_f = TimedWriter(output_r1_f, stats)
+        output_r2_f = TimedWriter(output_r2_f, stats)
+
+    seq_generator = None
+    if store is not None:
+        seq_generator = store.pairs(store.find(keep_IDs))   # The wanted pairs are found by scanning the ID column
+        if stats is not None:
+            seq_generator = count_records(seq_generator, stats)
+    elif not args.no_index and '-' not in (fwd_reads_fp, rev_reads_fp):
+        seq_generator = indexed_pairs(fwd_reads_fp, rev_reads_fp, keep_IDs, stats)
+    if seq_generator is not None:
+        hashed_inputs = []      # Only part of the inputs is read, so they aren't checksummed
+        for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in seq_generator:
+            output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f))
+            output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r))
+    elif args.processes > 1:
+        for reads1, reads2 in filter_paired_batches(fwd_read_f, rev_read_f, keep_IDs, args.processes, stats):
+            output_r1_f.write(reads1)
+            output_r2_f.write(reads2)
     else:
-        rev_read_f = open(rev_reads_fp,'U')
-
-    # Parse reads and return to a generator expression to reduce memory footprint:
-    seq_generator = filter_paired_fastq(fwd_read_f, rev_read_f, keep_IDs)
+        # Parse reads and return to a generator expression to reduce memory footprint:
+        seq_generator = filter_paired_fastq(fwd_read_f, rev_read_f, keep_IDs, stats)
 
-    # Write the parsed data to both output files
-    for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in seq_generator:
-        output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f)) # This will write out fastq output
-        output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r)) # This will write out fastq output
+        # Write the parsed data to both output files
+        for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in seq_generator:
+            output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f)) # This will write out fastq output
+            output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r)) # This will write out fastq output
 
     output_r1_f.close()
     output_r2_f.close()
+    if args.manifest:
+        write_manifest('%s/%s' % (manifest_dir, MANIFEST_FILE), [output_entry(fp, writer) for fp, writer in writers],
+                       [input_entry(fp, hashing_f) for fp, hashing_f in hashed_inputs])
+    if stats is not None:
+        stats.write_json(args.stats)
 
 if __name__ == "__main__":
     main()
@@ -7,60 +7,98 @@ __license__ = "GPL3"
 __version__ = "1.0"
 
 import argparse
-import gzip
+
+from fastq_input import open_fastq
+from fastq_offset_index import indexed_records, load_offset_index
+from gzip_writer import COMPRESS_LEVEL, GzipWriter, output_fastq_name
+from parallel_batches import format_records, map_batches, record_batches
+from read_id_index import ReadIDIndex, load_read_ids
+from read_store import ReadStore, is_read_store
+from run_stats import PROGRESS_READS, RunStats, TimedWriter, count_batches, parse_records
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-i', '--input', required=True, help="The input fastq file to search through. [REQUIRED]", metavar='Input.fastq')
-parser.add_argument('-o', '--output', required=True, help="The output fastq to create. [REQUIRED]", metavar='Output.fastq.gz')
-parser.add_argument('-n', '--names', required=True, help="The file containing the read IDs to search for. [REQUIRED]", metavar='Names.txt')
-args = parser.parse_args()
+parser.add_argument('-i', '--input', required=True, help="The input fastq file to search through, plain or gzip compressed, - for stdin, or a read store made by read_store.py (its R1 reads are filtered). [REQUIRED]", metavar='Input.fastq')
+parser.add_argument('-o', '--output', required=True, help="The output fastq to create, or - for stdout. [REQUIRED]", metavar='Output.fastq.gz')
+parser.add_argument('-z', '--compress_level', required=False, type=int, default=COMPRESS_LEVEL, choices=range(10), help="The gzip compression level of the output file, 0 writes an uncompressed fastq file. Default: %d" % COMPRESS_LEVEL, metavar='6')
+parser.add_argument('--compress_threads', required=False, type=int, default=1, help="The number of threads to compress the output file with. Default: 1", metavar='1')
+parser.add_argument('-t', '--processes', required=False, type=int, default=1, help="The number of processes to filter reads with. Default: 1", metavar='1')
+parser.add_argument('-n', '--names', required=True, help="The file containing the read IDs to search for, or a read ID index created by read_id_index.py. [REQUIRED]", metavar='Names.txt')
+parser.add_argument('--no_index', required=False, action='store_true', help="Scan the whole input file even if it has an offset index made by fastq_offset_index.py.")
+parser.add_argument('-s', '--stats', required=False, help="Report progress and write run statistics to this JSON file.", metavar='stats.json')
+
+# Read IDs to keep in the worker processes, set up once in each process by init_filter_worker
+worker_state = {}
 
-def get_ids(names_file):
-    return set([l.split()[0].strip() for l in names_file if not l.startswith('#') and l])
+def init_filter_worker(seqs_to_keep):
+    worker_state['seqs_to_keep'] = seqs_to_keep
 
-def minimalfastqparser(data):
-    if type(data) == str:
-        data = open(data, 'rU')
-    line_num = -1
-    record = []
-    for line in data:
-        line_num += 1
-        if line_num == 4:
-            yield record[0][1:], record[1], record[3]
-            line_num = 0
-            record = []
-        record.append(line.strip())
-    if record:
-        if record[0]:  # could be just an empty line at eof
-            yield record[0][1:], record[1], record[3]
-    if type(data) == file:
-        data.close()
+def filter_batch(batch):
+    """ Filters a batch of (record,) tuples, returning the fastq text of the records kept """
+    seqs_to_keep = worker_state['seqs_to_keep']
+    return format_records([record for record, in batch if record[0].split()[0] in seqs_to_keep])
 
+def filter_fastq(input, output, seqs_to_keep, compress_level=COMPRESS_LEVEL, compress_threads=1, processes=1, stats=None, offset_index=None):
+    output_f = GzipWriter(output, compress_level, compress_threads)
+    if stats is not None:
+        output_f = TimedWriter(output_f, stats)
+    if isinstance(seqs_to_keep, (ReadIDIndex, set, frozenset, dict)):
+        seqs_to_keep_lookup = seqs_to_keep
+    else:
+        seqs_to_keep_lookup = ReadIDIndex(seq_id.split()[0] for seq_id in seqs_to_keep)    # Membership tests on a list are far too slow
 
-def filter_fastq(input, output, seqs_to_keep):
-    input_seqs = minimalfastqparser(input)
-    output_f = gzip.open(output, 'w')
-    seqs_to_keep_lookup = {}.fromkeys([seq_id.split()[0] for seq_id in seqs_to_keep])
+    input_seqs = None
+    if isinstance(input, ReadStore):
+        input_seqs = input.records(input.find(seqs_to_keep_lookup))
+    elif offset_index is not None:
+        input_seqs = indexed_records(getattr(input, 'name', input), offset_index, seqs_to_keep_lookup)
+    if input_seqs is None:
+        if type(input) == str:
+            input = open_fastq(input)
+        input_seqs = parse_records(input, stats)
+    else:
+        processes = 1   # Only the wanted reads are read, which leaves nothing to share out
 
-    for seq_id, seq, qual in input_seqs:
-        if seq_id.split()[0] in seqs_to_keep_lookup:
-            output_f.write('@%s\n%s\n+\n%s\n' % (seq_id, seq, qual))
+    if processes > 1:
+        batches = record_batches([input_seqs])
+        if stats is not None:
+            batches = count_batches(batches, stats)
+        for records in map_batches(filter_batch, batches, processes, init_filter_worker, (seqs_to_keep_lookup,)):
+            output_f.write(records)
+    else:
+        input_sequence_count = 0
+        for seq_id, seq, qual in input_seqs:
+            input_sequence_count += 1
+            if stats is not None and not input_sequence_count % PROGRESS_READS:
+                stats.progress(input_sequence_count)
+            if seq_id.split()[0] in seqs_to_keep_lookup:
+                output_f.write('@%s\n%s\n+\n%s\n' % (seq_id, seq, qual))
+        if stats is not None:
+            stats.reads = input_sequence_count
     output_f.close()
 
 
 def main():
+    args = parser.parse_args()
     INFILE = args.input
-    OUTFILE = args.output
-    if OUTFILE.endswith('.fastq'):
-        print "Warning: Output files are automatically gzip compressed, adding correct extension to output file name."
-        OUTFILE += '.gz'
+    OUTFILE = output_fastq_name(args.output, args.compress_level)     # .gz only if the output is gzip compressed
     NAMES = args.names
-    keep_IDs = get_ids(open(NAMES, 'U')) # Creates a dictionary of seqIDs for seqs we want to keep
+    keep_IDs = load_read_ids(NAMES) # Creates an index of seqIDs for seqs we want to keep
 
-    if INFILE.endswith('.fastq'):
-        filter_fastq(INFILE, OUTFILE, keep_IDs)
-    elif INFILE.endswith('.fastq.gz'):
-        print "ERROR: Input file must be a non-compressed fastq file with the extension .fastq"
+    offset_index = None
+    if INFILE != '-' and not args.no_index and not is_read_store(INFILE):
+        offset_index = load_offset_index(INFILE)
+    if is_read_store(INFILE):
+        input_f = ReadStore(INFILE)     # The wanted reads are found by scanning its ID column
+    elif offset_index is None:
+        input_f = open_fastq(INFILE)    # Plain or gzip compressed, from the first bytes of the file, or stdin
+    else:
+        input_f = INFILE                # Opened by filter_fastq only if it has to scan the whole file after all
+    if args.stats:
+        stats = RunStats(input_f)
+        filter_fastq(input_f, OUTFILE, keep_IDs, args.compress_level, args.compress_threads, args.processes, stats, offset_index)
+        stats.write_json(args.stats)
+    else:
+        filter_fastq(input_f, OUTFILE, keep_IDs, args.compress_level, args.compress_threads, args.processes, offset_index=offset_index)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Fastq input for demultiplex_reads.py, dual_fastq_filter.py and fastq_filter.py: plain or gzip files, told apart by
+their first bytes rather than their extension, or stdin given as '-'.
+
+Gzip input is decompressed as a stream, one member after another, so it also works on pipes, which gzip.GzipFile can't
+read as it seeks in the file. Reading and decompressing run in a read-ahead thread that stays up to READ_AHEAD_BLOCKS
+blocks ahead of the parser. zlib and file reads release the GIL, so inflating the next blocks overlaps with parsing.
+
+With prefetch, each input is also split into records on its own thread, and the synchronized loops over R1, R2 and
+the index reads take already parsed batches from bounded queues. The time the main loop spends waiting on each queue
+shows which input is holding the run up. Gzip files can instead be decompressed by an external command such as
+'gzip -dc' or 'pigz -dc', which runs on another core without the GIL.
+
+A StreamPosition records access points (gzip member starts, or plain file blocks) and the number of lines before
+each, so that a checkpointed run can later reopen the input at an access point and skip lines up to the next read.
+"""
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from Queue import Queue
+from bisect import bisect_right
+from itertools import chain
+
+from checksums import HashingFile
+from fastq_parser import ParseError, fastq_batches
+
+# Number of compressed (or plain) bytes read from the input at a time
+BLOCK_SIZE = 1 << 20
+
+# Number of blocks the read-ahead thread may get ahead of the reader
+READ_AHEAD_BLOCKS = 4
+
+# Number of parsed batches (of one fastq_parser block each) an input thread may get ahead of the main loop
+PREFETCH_BATCHES = 4
+
+# Minimum number of uncompressed bytes between two access points recorded by a StreamPosition
+POSITION_SPACING = 1 << 22
+
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def is_gzip(fp):
+    in_f = open(fp, 'rb')
+    magic = in_f.read(2)
+    in_f.close()
+    return magic == GZIP_MAGIC
+
+
+def raw_blocks(raw_f, block_size=BLOCK_SIZE):
+    """ Yields the blocks read from a file until its end """
+    while True:
+        data = raw_f.read(block_size)
+        if not data:
+            break
+        yield data
+
+
+def plain_blocks(raw_f, offset):
+    """ Yields the blocks of a plain file from a byte offset """
+    raw_f.seek(offset)
+    return raw_blocks(raw_f)
+
+
+def inflate_blocks(blocks, compressed_offset=0, uncompressed_offset=0, checkpoints=None, checkpoint_spacing=0):
+    """ Yields the decompressed blocks of a stream of gzip data starting at a member.
+
+    If checkpoints is given, (compressed offset, uncompressed offset) is appended to it at the start of every member
+    at least checkpoint_spacing bytes past the last access point.
+    """
+    data = ''
+    decompressor = None
+    while True:
+        if not data:
+            data = next(blocks, '')
+            if not data:
+                break
+        if decompressor is None:
+            if data.startswith('\x00'):
+                break               # Zero padding after the last member
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if checkpoints is not None and (not checkpoints or uncompressed_offset - checkpoints[-1][1] >= checkpoint_spacing):
+                checkpoints.append((compressed_offset, uncompressed_offset))
+        block = decompressor.decompress(data)
+        unused = decompressor.unused_data
+        compressed_offset += len(data) - len(unused)
+        data = unused
+        if unused:
+            decompressor = None     # The member has ended, the rest is the next member
+        if block:
+            uncompressed_offset += len(block)
+            yield block
+    if decompressor is not None:
+        # The member may have ended with the data. If it did, zlib leaves anything fed to it after the end unused.
+        try:
+            decompressor.decompress(GZIP_MAGIC)
+        except zlib.error:
+            pass
+        if decompressor.unused_data != GZIP_MAGIC:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached.")
+
+
+def gzip_blocks(raw_f, compressed_offset, uncompressed_offset=0, checkpoints=None, checkpoint_spacing=0):
+    """ Yields the decompressed blocks of a gzip file from the start of the member at compressed_offset """
+    raw_f.seek(compressed_offset)
+    return inflate_blocks(raw_blocks(raw_f), compressed_offset, uncompressed_offset, checkpoints, checkpoint_spacing)
+
+
+def skip_lines(blocks, lines):
+    """ Yields the data of a stream of blocks after its first lines lines """
+    for block in blocks:
+        newlines = block.count('\n')
+        if newlines < lines:
+            lines -= newlines
+            continue
+        yield block.split('\n', lines)[-1]
+        break
+    else:
+        if lines:
+            raise ParseError, ("Fastq file ended %d lines before the read to continue from, it has changed since the checkpoint." % lines)
+    for block in blocks:
+        yield block
+
+
+class StreamPosition(object):
+    """ Access points of an input stream and the number of lines before each, to continue reading after any record.
+
+    start is the (compressed offset, uncompressed offset, lines before it) access point to start reading at, and
+    records the number of records from the start of the file to skip.
+    """
+
+    def __init__(self, start=(0, 0, 0), records=0):
+        self.start = tuple(start)
+        self.records = records
+        self.checkpoints = []   # (compressed offset, uncompressed offset) access points, gzip ones added by inflate_blocks
+        self.lines = []         # Number of lines before each access point
+
+    def track(self, blocks, plain=False):
+        """ Passes the decompressed blocks read from start through, counting the lines before each access point """
+        offset, lines = self.start[1], self.start[2]
+        for block in blocks:
+            if plain and (not self.checkpoints or offset - self.checkpoints[-1][1] >= POSITION_SPACING):
+                self.checkpoints.append((offset, offset))
+            while len(self.lines) < len(self.checkpoints):
+                self.lines.append(lines)
+            offset += len(block)
+            lines += block.count('\n')
+            yield block
+
+    def resume_point(self, records):
+        """ Returns the (compressed offset, uncompressed offset, lines before it) of the last access point before a record """
+        i = bisect_right(self.lines, 4 * records) - 1
+        if i < 0:
+            return self.start
+        return self.checkpoints[i] + (self.lines[i],)
+
+
+class BackgroundIterator(object):
+    """ Iterates over an iterable on its own thread, up to max_items ahead of the consumer.
+
+    Exceptions are raised in the consumer. wait_seconds is the time the consumer spent waiting for items and
+    blocked_seconds the time the thread spent waiting for room in the queue.
+    """
+
+    def __init__(self, iterable, max_items):
+        self.queue = Queue(max_items)
+        self.wait_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.done = False
+        self.thread = threading.Thread(target=self.produce, args=(iterable,))
+        self.thread.daemon = True   # Don't keep the process alive if the consumer stops early
+        self.thread.start()
+
+    def produce(self, iterable):
+        try:
+            for item in iterable:
+                start = time.time()
+                self.queue.put((True, item))
+                self.blocked_seconds += time.time() - start
+            self.queue.put((False, None))
+        except Exception:
+            self.queue.put((False, sys.exc_info()))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.done:
+            raise StopIteration
+        start = time.time()
+        has_item, item = self.queue.get()
+        self.wait_seconds += time.time() - start
+        if has_item:
+            return item
+        self.done = True
+        if item is not None:
+            raise item[0], item[1], item[2]
+        raise StopIteration
+
+
+class ReadAheadFile(object):
+    """ A read-only file of the data in a stream of blocks, produced by a thread up to read_ahead blocks ahead """
+
+    def __init__(self, blocks, name, fileobj, read_ahead=READ_AHEAD_BLOCKS):
+        self.name = name
+        self.fileobj = fileobj      # The file on disk, for the position and size used by run_stats
+        self.buffer = ''
+        self.at_eof = False
+        if read_ahead > 0:
+            blocks = BackgroundIterator(blocks, read_ahead)
+        self.next_block = lambda: next(blocks, '')
+
+    def read(self, size=-1):
+        while not self.at_eof and (size < 0 or len(self.buffer) < size):
+            block = self.next_block()
+            if not block:
+                self.at_eof = True
+            elif self.buffer:
+                self.buffer += block
+            else:
+                self.buffer = block
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class PrefetchedRecords(object):
+    """ The records of a fastq input, parsed in batches on their own thread. Iterates like fastqparser. """
+
+    def __init__(self, reads_f, max_batches=PREFETCH_BATCHES):
+        self.name = reads_f.name
+        self.fileobj = reads_f.fileobj
+        self.hashing_f = reads_f.hashing_f
+        self.position = reads_f.position
+        self.batches = BackgroundIterator(fastq_batches(reads_f), max_batches)
+
+    def __iter__(self):
+        return chain.from_iterable(self.batches)
+
+
+def command_blocks(process, command):
+    """ Yields the blocks of the output of a decompression process, raising IOError if the command fails """
+    for block in raw_blocks(process.stdout):
+        yield block
+    if process.wait():
+        raise IOError("'%s' failed with exit status %d." % (command, process.returncode))
+
+
+def open_fastq(fp, digests=(), read_ahead=READ_AHEAD_BLOCKS, prefetch=False, decompressor=None, position=None):
+    """ Opens a plain or gzip compressed fastq file, or stdin if fp is '-', for reading with the fastq parser.
+
+    If digests are given (e.g. ('md5',)), the checksums of the bytes read are kept by the HashingFile in hashing_f.
+    With prefetch, the records are parsed on the input's thread and a PrefetchedRecords is returned. A gzip file
+    (not stdin, and not checksummed, as the command reads the file itself) is decompressed by the decompressor
+    command if one is given.
+
+    If a StreamPosition is given, the access points of the input are recorded in it as it is read, and the records
+    before position.records are skipped, reading from its start access point unless every byte has to be checksummed.
+    """
+    if fp == '-':
+        raw_f = sys.stdin
+    else:
+        raw_f = open(fp, 'rb')
+    hashing_f = None
+    if digests:
+        raw_f = hashing_f = HashingFile(raw_f, digests)
+    if prefetch:
+        read_ahead = 0      # The prefetch thread does the reading and decompressing itself
+    first = raw_f.read(BLOCK_SIZE)
+    gzipped = first.startswith(GZIP_MAGIC)
+    blocks = chain([first], raw_blocks(raw_f))
+    start = (0, 0, 0)
+    checkpoints = None
+    if position is not None:
+        if position.start[0] and hashing_f is None and fp != '-':
+            start = position.start
+            raw_f.seek(start[0])
+            blocks = raw_blocks(raw_f)
+        position.start = start
+        checkpoints = position.checkpoints
+    if gzipped:
+        if decompressor and fp != '-' and hashing_f is None and not start[0]:
+            raw_f.close()
+            command = shlex.split(decompressor) + [fp]
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+            raw_f = process.stdout  # A pipe, so run_stats reports progress without an ETA
+            blocks = command_blocks(process, ' '.join(command))
+        else:
+            blocks = inflate_blocks(blocks, start[0], start[1], checkpoints, POSITION_SPACING)
+    if position is not None:
+        blocks = skip_lines(position.track(blocks, not gzipped), 4 * position.records - start[2])
+    reads_f = ReadAheadFile(blocks, fp, raw_f, read_ahead)
+    reads_f.hashing_f = hashing_f
+    reads_f.position = position
+    if prefetch:
+        return PrefetchedRecords(reads_f)
+    return reads_f
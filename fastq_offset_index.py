@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Sidecar offset index for pulling a subset of reads out of a large fastq or fastq.gz file without reading all of it.
+
+fastq_offset_index.py -i Undetermined_R1.fastq.gz writes Undetermined_R1.fastq.gz.fqi, holding the packed read ID of
+every record in file order, the offset of every SPARSE-th record and, for gzip files, access points at gzip member
+boundaries. fastq_filter.py and dual_fastq_filter.py use the sidecar when it is there and up to date: the wanted IDs
+are found in the index, and only the parts of the file holding them are read, nearby records sharing one read.
+
+Decompression can only start at the beginning of a gzip member, so a file compressed as a single member (e.g. by the
+gzip command) has a single access point and is read from the start up to its last wanted record. The output of the
+scripts in this repository, bcl2fastq and bgzip is made of many small members and gets an access point every
+CHECKPOINT_SPACING bytes.
+"""
+import argparse
+import os
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import compress, count, imap
+
+from fastq_input import gzip_blocks, is_gzip, plain_blocks
+from fastq_parser import ParseError, check_records
+from read_id_index import PACKED_TYPECODE, ReadIDIndex
+
+INDEX_MAGIC = 'FASTQIDX\t1\n'
+INDEX_EXTENSION = '.fqi'
+
+# The offset of every SPARSE-th record is stored, the records in between are found by reading forward
+SPARSE = 32
+
+# Minimum number of uncompressed bytes between two gzip access points
+CHECKPOINT_SPACING = 1 << 20
+
+# Records less than this many bytes past the current position are read through rather than seeked to
+READ_GAP = 1 << 18
+
+# Packed ID of reads whose names can't be packed, these are kept by name
+UNPACKED = (1 << 64) - 1
+
+# Above this fraction of the reads a plain scan of the file is faster than seeking to each read
+MAX_INDEXED_FRACTION = 0.25
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input', required=True, nargs='+', help="The fastq or fastq.gz files to index. [REQUIRED]", metavar='Input.fastq.gz')
+
+
+class RecordReader(object):
+    """ Reads whole fastq records from a stream of blocks, starting at a known byte offset and record number """
+
+    def __init__(self, blocks, position, record):
+        self.blocks = blocks
+        self.buffer = ''
+        self.start = 0              # Index in the buffer of the byte at position
+        self.position = position
+        self.record = record
+        self.at_eof = False
+
+    def fill(self):
+        block = next(self.blocks, '')
+        if not block:
+            if self.at_eof:
+                raise ParseError, ("Fastq file is truncated or has changed since it was indexed, record %d is incomplete." % (self.record + 1))
+            self.at_eof = True
+            block = '\n'            # The last record may be missing its newline
+        self.buffer = self.buffer[self.start:] + block
+        self.start = 0
+
+    def skip_bytes(self, size):
+        while size > len(self.buffer) - self.start:
+            size -= len(self.buffer) - self.start
+            self.position += len(self.buffer) - self.start
+            self.buffer = ''
+            self.start = 0
+            self.fill()
+        self.start += size
+        self.position += size
+
+    def next_record(self):
+        """ Returns the next record as (header without the @, sequence, quality) """
+        while True:
+            end = self.start
+            for line in xrange(4):
+                end = self.buffer.find('\n', end) + 1
+                if not end:
+                    break
+            if end:
+                break
+            self.fill()
+        lines = self.buffer[self.start:end].split('\n')
+        if not lines[0].startswith('@'):
+            raise ParseError, ("Fastq record %d does not start with '@', the file has changed since it was indexed." % (self.record + 1))
+        self.position += end - self.start
+        self.start = end
+        self.record += 1
+        return lines[0][1:].rstrip('\r'), lines[1].rstrip('\r'), lines[3].rstrip('\r')
+
+
+class OffsetIndex(object):
+    """ The packed read ID of every record of a fastq file, with the offsets needed to read any record directly """
+
+    def __init__(self):
+        self.ids = ReadIDIndex()            # Only used to pack read names, with its own instrument:run:flowcell prefixes
+        self.keys = array(PACKED_TYPECODE)  # Packed read ID of each record, in file order
+        self.offsets = array(PACKED_TYPECODE)
+        self.fallback = []                  # (record number, read ID) of the records whose names couldn't be packed
+        self.checkpoints = []               # (compressed offset, uncompressed offset) access points of a gzip file
+        self.source_size = 0
+        self.source_mtime = 0
+
+    @classmethod
+    def build(cls, fp):
+        """ Indexes a fastq or fastq.gz file in a single pass """
+        index = cls()
+        source = os.stat(fp)
+        index.source_size = source.st_size
+        index.source_mtime = int(source.st_mtime)
+        raw_f = open(fp, 'rb')
+        if is_gzip(fp):
+            blocks = gzip_blocks(raw_f, 0, 0, index.checkpoints, CHECKPOINT_SPACING)
+        else:
+            blocks = plain_blocks(raw_f, 0)
+
+        pack = index.ids.pack
+        keys = index.keys
+        base = 0            # Offset of the start of the current block
+        record_num = 0
+        leftover = ''
+        for block in blocks:
+            block = leftover + block
+            lines = block.split('\n')
+            leftover = lines.pop()
+            complete = len(lines) - len(lines) % 4
+            if complete != len(lines):
+                lines.append(leftover)
+                leftover = '\n'.join(lines[complete:])
+                del lines[complete:]
+            index.add_records(lines, base, record_num, pack, keys)
+            base += len(block) - len(leftover)
+            record_num += len(lines) / 4
+        lines = leftover.rstrip('\r\n').split('\n') if leftover.strip() else []
+        if len(lines) % 4:
+            raise ParseError, ("Fastq file is truncated, the last record (%d) is incomplete." % (record_num + 1))
+        index.add_records(lines, base, record_num, pack, keys)
+        raw_f.close()
+        return index
+
+    def add_records(self, lines, base, record_num, pack, keys):
+        """ Adds the records of a list of complete fastq lines starting at byte offset base """
+        headers = lines[0::4]
+        check_records(headers, lines[1::4], lines[2::4], lines[3::4], record_num)
+        line_lengths = map(len, lines)
+        position = base
+        line = 0
+        first_sparse = -record_num % SPARSE
+        for i in xrange(first_sparse, len(headers), SPARSE):
+            position += sum(line_lengths[line:4 * i]) + 4 * i - line     # Line lengths plus their newlines
+            line = 4 * i
+            self.offsets.append(position)
+        for i, header in enumerate(headers):
+            packed_id = pack(header[1:].split()[0].rstrip('\r'), add_prefix=True)
+            if packed_id is None:
+                self.fallback.append((record_num + i, header[1:].split()[0].rstrip('\r')))
+                packed_id = UNPACKED
+            keys.append(packed_id)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def wanted_keys(self, seqs_to_keep):
+        """ Returns the set of packed IDs, in this index's packing, of a ReadIDIndex or a collection of read IDs """
+        return self.ids.repack(seqs_to_keep)
+
+    def find(self, seqs_to_keep):
+        """ Returns the sorted record numbers of the reads whose IDs are in seqs_to_keep, testing every key of the index in turn """
+        wanted = self.wanted_keys(seqs_to_keep)
+        # One set lookup per indexed read, driven from C by itertools, so this grows with the file, not with the wanted reads
+        record_nums = list(compress(count(), imap(wanted.__contains__, self.keys)))
+        fallback = [record_num for record_num, read_id in self.fallback if read_id in seqs_to_keep]
+        if fallback:
+            record_nums = sorted(record_nums + fallback)
+        return record_nums
+
+    def records(self, fp, record_nums):
+        """ Yields the records with the given sorted record numbers from the indexed file """
+        raw_f = open(fp, 'rb')
+        access_points = [uncompressed_offset for compressed_offset, uncompressed_offset in self.checkpoints]
+        reader = None
+        for record_num in record_nums:
+            anchor = record_num / SPARSE
+            offset = self.offsets[anchor]
+            if self.checkpoints:
+                checkpoint = self.checkpoints[bisect_right(access_points, offset) - 1]
+            else:
+                checkpoint = (offset, offset)
+            if reader is None or reader.record > record_num or checkpoint[1] - reader.position > READ_GAP:
+                # Start over at the closest access point, a gzip member or the record itself
+                if self.checkpoints:
+                    blocks = gzip_blocks(raw_f, checkpoint[0], checkpoint[1])
+                else:
+                    blocks = plain_blocks(raw_f, offset)
+                reader = RecordReader(blocks, checkpoint[1], -1)
+            if reader.record < anchor * SPARSE:
+                reader.skip_bytes(offset - reader.position)
+                reader.record = anchor * SPARSE
+            while reader.record < record_num:
+                reader.next_record()
+            yield reader.next_record()
+        raw_f.close()
+
+    def save(self, fp):
+        """ Writes the index to a file that can be reloaded with OffsetIndex.load """
+        prefixes = sorted(self.ids.prefix_ids, key=self.ids.prefix_ids.get)
+        out_f = open(fp, 'wb')
+        out_f.write(INDEX_MAGIC)
+        out_f.write('%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s\n' % (self.source_size, self.source_mtime, len(self.keys), len(self.offsets), len(prefixes),
+                                                          len(self.fallback), len(self.checkpoints), sys.byteorder))
+        for name in prefixes:
+            out_f.write(name + '\n')
+        for record_num, read_id in self.fallback:
+            out_f.write('%d\t%s\n' % (record_num, read_id))
+        for compressed_offset, uncompressed_offset in self.checkpoints:
+            out_f.write('%d\t%d\n' % (compressed_offset, uncompressed_offset))
+        self.keys.tofile(out_f)
+        self.offsets.tofile(out_f)
+        out_f.close()
+
+    @classmethod
+    def load(cls, fp):
+        """ Reads an index written by OffsetIndex.save """
+        in_f = open(fp, 'rb')
+        if in_f.readline() != INDEX_MAGIC:
+            raise ValueError("%s is not a fastq offset index file." % fp)
+        fields = in_f.readline().split()
+        source_size, source_mtime, num_keys, num_offsets, num_prefixes, num_fallback, num_checkpoints = map(int, fields[:7])
+        index = cls()
+        index.source_size = source_size
+        index.source_mtime = source_mtime
+        for prefix_id in range(num_prefixes):
+            index.ids.prefix_ids[in_f.readline().rstrip('\n')] = prefix_id
+        for i in range(num_fallback):
+            record_num, read_id = in_f.readline().rstrip('\n').split('\t')
+            index.fallback.append((int(record_num), read_id))
+        for i in range(num_checkpoints):
+            compressed_offset, uncompressed_offset = in_f.readline().split()
+            index.checkpoints.append((int(compressed_offset), int(uncompressed_offset)))
+        index.keys.fromfile(in_f, num_keys)
+        index.offsets.fromfile(in_f, num_offsets)
+        if fields[7] != sys.byteorder:
+            index.keys.byteswap()
+            index.offsets.byteswap()
+        in_f.close()
+        return index
+
+    def is_current(self, fp):
+        """ Checks that the indexed file hasn't been changed since it was indexed """
+        source = os.stat(fp)
+        return source.st_size == self.source_size and int(source.st_mtime) == self.source_mtime
+
+
+def load_offset_index(fp):
+    """ Returns the sidecar index of a fastq file, or None if there isn't one or it is out of date """
+    index_fp = fp + INDEX_EXTENSION
+    if not os.path.exists(index_fp):
+        return None
+    index = OffsetIndex.load(index_fp)
+    if not index.is_current(fp):
+        print >> sys.stderr, "Warning: %s is out of date for %s, reading the whole file. Rerun fastq_offset_index.py to update it." % (index_fp, fp)
+        return None
+    return index
+
+
+def indexed_records(fp, index, seqs_to_keep):
+    """ Returns the records of fp whose IDs are in seqs_to_keep, or None if so many are wanted that scanning fp is faster """
+    if len(seqs_to_keep) > MAX_INDEXED_FRACTION * len(index):
+        return None
+    return index.records(fp, index.find(seqs_to_keep))
+
+
+def main():
+    args = parser.parse_args()
+    for fp in args.input:
+        index = OffsetIndex.build(fp)
+        index_fp = fp + INDEX_EXTENSION     # The filters only look for the index next to the fastq file
+        index.save(index_fp)
+        print "Indexed %d reads of %s (%d gzip access points) into %s" % (len(index), fp, len(index.checkpoints), index_fp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Block based fastq parser shared by demultiplex_reads.py, dual_fastq_filter.py and fastq_filter.py.
+
+The input is read in large blocks that are split into lines in one go, and whole records are sliced out of the lines
+of each block, so there is no per-line Python work. A record that spans two blocks is carried over to the next block.
+"""
+import gc
+from itertools import imap, izip, repeat
+from operator import itemgetter
+
+# Number of bytes read from the input at a time
+BLOCK_SIZE = 1 << 22
+
+strip_at = itemgetter(slice(1, None))
+
+
+class ParseError(Exception):
+    pass
+
+
+def check_records(headers, sequences, pluses, qualities, record_num):
+    """ Checks the structure of a batch of records, raising a ParseError that points at the first bad record """
+    if (all(imap(str.startswith, headers, repeat('@'))) and
+            (pluses.count('+') == len(pluses) or all(imap(str.startswith, pluses, repeat('+')))) and
+            map(len, sequences) == map(len, qualities)):
+        return
+    for i, (header, sequence, plus, quality) in enumerate(izip(headers, sequences, pluses, qualities)):
+        if not header.startswith('@'):
+            raise ParseError, ("Fastq record %d does not start with '@': %s" % (record_num + i + 1, header))
+        if not plus.startswith('+'):
+            raise ParseError, ("Fastq record %d (%s) is missing its '+' line." % (record_num + i + 1, header[1:]))
+        if len(sequence) != len(quality):
+            raise ParseError, ("Fastq record %d (%s) has a sequence and quality of different lengths." % (record_num + i + 1, header[1:]))
+
+
+def split_records(lines, record_num):
+    """ Returns the records of a list of complete fastq lines as (header without the @, sequence, quality) tuples """
+    headers = lines[0::4]
+    sequences = lines[1::4]
+    qualities = lines[3::4]
+    check_records(headers, sequences, lines[2::4], qualities, record_num)
+    # None of the new tuples can be part of a reference cycle, so don't let them trigger garbage collections
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return zip(map(strip_at, headers), sequences, qualities)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def fastq_batches(data, block_size=BLOCK_SIZE):
+    """ Yields lists of (header without the @, sequence, quality) tuples, one list per block of the input """
+    if type(data) == str:
+        data = open(data, 'rU')
+    record_num = 0
+    leftover = ''
+    while True:
+        block = data.read(block_size)
+        if not block:
+            break
+        block = leftover + block
+        if '\r' in block:
+            block = block.replace('\r\n', '\n')
+        lines = block.split('\n')
+        leftover = lines.pop()                   # The last line is incomplete, or empty if the block ended on a newline
+        complete = len(lines) - len(lines) % 4
+        if complete != len(lines):
+            lines.append(leftover)
+            leftover = '\n'.join(lines[complete:])
+            del lines[complete:]
+        if lines:
+            yield split_records(lines, record_num)
+            record_num += len(lines) / 4
+
+    lines = leftover.rstrip('\r\n').split('\n') if leftover.strip() else []    # Could be just an empty line at eof
+    if len(lines) % 4:
+        raise ParseError, ("Fastq file is truncated, the last record (%d) is incomplete." % (record_num + 1))
+    if lines:
+        yield split_records(lines, record_num)
+    if type(data) == file:
+        data.close()
+
+
+def fastqparser(data, block_size=BLOCK_SIZE):
+    """ Yields the header without the @ symbol, the DNA sequence, and quality sequence of each record as strings """
+    for batch in fastq_batches(data, block_size):
+        for record in batch:
+            yield record
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Gzip output writer shared by demultiplex_reads.py, dual_fastq_filter.py, fastq_filter.py and per_sample_raw_reads.py.
+
+Output is buffered into blocks that are each compressed as a separate gzip member, optionally on a pool of threads
+(zlib releases the GIL while compressing) so compression keeps up with parsing. The concatenated members are a standard
+multi-member gzip file, which gzip -t, zcat and the SRA all read as a single stream. Checksums of the bytes written
+can be computed on the way out, so that a file never has to be read back just to checksum it.
+
+checkpoint() writes out everything written so far and syncs the file, so that a run that is killed later can reopen
+the file with resume_from, truncated to that point, and carry on writing it.
+"""
+import hashlib
+import os
+import struct
+import sys
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Default compression level, the same as the gzip command. Level 0 writes uncompressed text.
+COMPRESS_LEVEL = 6
+
+# Number of uncompressed bytes in each gzip member
+BLOCK_SIZE = 1 << 19
+
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'    # No file name or mtime, so output only depends on the data
+
+pools = {}
+
+
+def compression_pool(threads):
+    """ Returns the thread pool shared by all writers using the given number of threads """
+    if threads not in pools:
+        pools[threads] = ThreadPool(threads)
+    return pools[threads]
+
+
+def fastq_extension(compress_level):
+    """ Returns the file extension for fastq output written at the given compression level """
+    if compress_level:
+        return '.fastq.gz'
+    return '.fastq'
+
+
+def output_fastq_name(fp, compress_level):
+    """ Returns an output file name with a .gz extension only if it is compressed, warning if it had to be changed """
+    if fp.endswith('.fastq') and compress_level:
+        print >> sys.stderr, "Warning: Output files are automatically gzip compressed, adding correct extension to output file name."
+        return fp + '.gz'
+    if fp.endswith('.gz') and not compress_level:
+        print >> sys.stderr, "Warning: Output files are not compressed at compression level 0, removing the .gz extension from output file name."
+        return fp[:-len('.gz')]
+    return fp
+
+
+def compress_member(data, compress_level):
+    """ Compresses data into a complete gzip member """
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([GZIP_HEADER, compressor.compress(data), compressor.flush(),
+                    struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+
+class GzipWriter(object):
+    """ Writes gzip compressed output to a file path, or to stdout if the path is '-'.
+
+    The hashlib digests named in digests (e.g. ('md5', 'sha256')) are computed on the bytes written to the file, and
+    are available from hexdigests() along with the size and the number of fastq reads once the writer is closed.
+    If resume_from is the (size, lines) returned by checkpoint() for the same file, the file is truncated to that size
+    and written on from there.
+    """
+
+    def __init__(self, fp, compress_level=COMPRESS_LEVEL, threads=1, block_size=BLOCK_SIZE, digests=(), resume_from=None):
+        if fp == '-':
+            self.out_f = sys.stdout
+        elif resume_from is None:
+            self.out_f = open(fp, 'wb')
+        else:
+            self.out_f = open(fp, 'r+b')
+        self.name = fp
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.threads = threads
+        self.buffer = []
+        self.buffered = 0
+        self.members = 0
+        self.lines = 0
+        self.size = 0             # Number of bytes written to the file
+        self.hashes = [(name, hashlib.new(name)) for name in digests]
+        self.pending = deque()    # Blocks being compressed by the pool, in the order they have to be written
+        self.pool = compression_pool(threads) if threads > 1 and compress_level else None
+        if resume_from is not None:
+            self.resume(*resume_from)
+
+    @property
+    def reads(self):
+        return self.lines / 4
+
+    def write(self, data):
+        self.lines += data.count('\n')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            # Every member holds exactly block_size bytes, so the output doesn't depend on how the data was written
+            data = ''.join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in xrange(0, end, self.block_size):
+                self.write_member(data[start:start + self.block_size])
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def write_member(self, block):
+        """ Compresses a block as one gzip member, leaving it to the pool if there is one """
+        self.members += 1
+        if not self.compress_level:
+            self.write_out(block)
+        elif self.pool is None:
+            self.write_out(compress_member(block, self.compress_level))
+        else:
+            self.pending.append(self.pool.apply_async(compress_member, (block, self.compress_level)))
+            while len(self.pending) > 2 * self.threads:    # Limit the memory held by blocks waiting to be written
+                self.write_out(self.pending.popleft().get())
+
+    def write_out(self, data):
+        self.write_hashes(data)
+        self.out_f.write(data)
+
+    def checkpoint(self):
+        """ Writes out all the data written so far, the buffer as a short member, and syncs the file to disk.
+
+        Returns the (size, lines) to give as resume_from to continue the file from this point.
+        """
+        if self.buffered:
+            self.write_member(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self.write_out(self.pending.popleft().get())
+        self.out_f.flush()
+        os.fsync(self.out_f.fileno())
+        return self.size, self.lines
+
+    def resume(self, size, lines):
+        """ Truncates the file to the size it had at a checkpoint, checksumming the data kept, to write on from there """
+        if os.fstat(self.out_f.fileno()).st_size < size:
+            raise IOError("%s is shorter than it was at the checkpoint, it can't be resumed." % self.name)
+        self.out_f.truncate(size)
+        if not self.hashes:
+            self.size = size
+        while self.size < size:
+            self.write_hashes(self.out_f.read(min(self.block_size, size - self.size)))
+        self.out_f.seek(size)
+        self.lines = lines
+        self.members = int(size > 0)
+
+    def write_hashes(self, data):
+        for name, digest in self.hashes:
+            digest.update(data)
+        self.size += len(data)
+
+    def hexdigests(self):
+        return dict((name, digest.hexdigest()) for name, digest in self.hashes)
+
+    def close(self):
+        if self.buffered:
+            self.write_member(''.join(self.buffer))
+        while self.pending:
+            self.write_out(self.pending.popleft().get())
+        if not self.members and self.compress_level:
+            self.write_out(compress_member('', self.compress_level))    # An empty file still has to be valid gzip
+        if self.out_f is sys.stdout:
+            self.out_f.flush()
+        else:
+            self.out_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Multi-process execution of the per-read work of demultiplex_reads.py, dual_fastq_filter.py and fastq_filter.py.
+
+The reader splits the synchronized input streams into batches of records, a pool of worker processes does the header
+checks, lookups and record formatting of each batch, and the results are handed back to the writer in input order so
+that the output is identical for any number of processes. Only a bounded number of batches are in flight at a time.
+"""
+from collections import deque
+from itertools import islice, izip
+from multiprocessing import Pool
+
+# Number of records in each batch sent to a worker
+BATCH_SIZE = 20000
+
+
+def record_batches(record_iters, batch_size=BATCH_SIZE):
+    """ Yields lists of up to batch_size tuples of the next record from each of the synchronized record iterators """
+    records = izip(*record_iters)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def map_batches(process_batch, batches, processes=1, initializer=None, initargs=(), max_pending=None):
+    """ Yields process_batch(batch) for every batch, in order, using a pool of processes if processes > 1.
+
+    process_batch must be a module level function. Any state it needs (e.g. a barcode lookup) should be set up by
+    initializer, which is run once in each worker process rather than sending the state with every batch.
+    """
+    if processes <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for batch in batches:
+            yield process_batch(batch)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * processes
+    pool = Pool(processes, initializer, initargs)
+    try:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(process_batch, (batch,)))
+            while len(pending) >= max_pending:    # Stop reading until the oldest batch is done, bounding memory use
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def format_records(records):
+    """ Returns fastq text for a list of (header, sequence, quality) tuples """
+    return ''.join(['@%s\n%s\n+\n%s\n' % record for record in records])
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__credits__ = ["Created using code lifted from the QIIME project (www.qiime.org)."]
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Create the raw Read 1 and Read 2 files for every sample in a QIIME mapping file in a single pass over the raw reads,
+per_sample_raw_reads.py -m Map.txt -s seqs.fna -f Undetermined_R1.fastq.gz -r Undetermined_R2.fastq.gz -o Raw_reads/
+"""
+import argparse
+import hashlib
+import sys
+import time
+
+from checksums import MANIFEST_FILE, HashingFile, input_entry, manifest_digests, md5sum_line, output_entry, write_manifest
+from demultiplex_reads import check_map, create_dir
+from dual_fastq_filter import filter_paired_fastq
+from fastq_input import open_fastq
+from fastq_parser import ParseError
+from gzip_writer import COMPRESS_LEVEL, GzipWriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', '--mapping_file', required=True, help="The QIIME mapping file used for the initial demultiplexing. [REQUIRED]", metavar='Map.txt')
+parser.add_argument('-s', '--seqs', required=True, help="The demultiplexed seqs.fna file created by QIIME. [REQUIRED]", metavar='seqs.fna')
+parser.add_argument('-f', '--forward', required=True, help="The raw Read 1 fastq file to search through. [REQUIRED]", metavar='Undetermined_R1.fastq.gz')
+parser.add_argument('-r', '--reverse', required=True, help="The raw Read 2 fastq file to search through. [REQUIRED]", metavar='Undetermined_R2.fastq.gz')
+parser.add_argument('-o', '--output_dir', required=False, default='.', help="The output directory to use, creating if not already present. Default: current directory", metavar='Raw_reads')
+parser.add_argument('-z', '--compress_level', required=False, type=int, default=COMPRESS_LEVEL, choices=range(1, 10), help="The gzip compression level of the output files. Default: %d" % COMPRESS_LEVEL, metavar='6')
+parser.add_argument('--compress_threads', required=False, type=int, default=1, help="The number of threads to compress the output files with. Default: 1", metavar='1')
+parser.add_argument('--sha256', required=False, action='store_true', help="Add SHA-256 checksums to manifest.json.")
+parser.add_argument('-l', '--log', required=False, help="The log file to write. Default: Log_<timestamp>.txt in the output directory", metavar='Log.txt')
+
+
+def md5sum(fp, name=None):
+    """ Returns the md5 checksum line for a file in the same format as the md5sum command """
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    return "%s  %s" % (md5.hexdigest(), name or fp)
+
+
+def timestamp():
+    return time.strftime('%Y-%m-%d %H:%M')
+
+
+def read_sample_ids(seqs_f, sample_ids):
+    """ Reads seqs.fna once, returning a dict of raw read ID to sample ID and the number of seqs for each sample """
+    read_to_sample = {}
+    sample_seq_counts = dict.fromkeys(sample_ids, 0)
+    if type(seqs_f) == str:
+        seqs_f = open(seqs_f, 'U')
+    for line in seqs_f:
+        if line.startswith('>'):
+            fields = line[1:].split()                     # e.g. >SampleA_12 M00123:45:000000000-A1B2C:1:1101:15589:1331 orig_bc=...
+            sample_id = fields[0].rsplit('_', 1)[0]
+            if sample_id in sample_seq_counts and len(fields) > 1:
+                read_to_sample[fields[1]] = sample_id
+                sample_seq_counts[sample_id] += 1
+    return read_to_sample, sample_seq_counts
+
+
+def main():
+    args = parser.parse_args()
+    output_dir = args.output_dir
+    create_dir(output_dir, fail_on_exist=False)
+    log_fp = args.log or '%s/Log_%s.txt' % (output_dir, time.strftime('%Y%m%d-%H%M'))
+    log_f = open(log_fp, 'w')
+
+    def log(line=''):
+        print line
+        log_f.write(line + '\n')
+
+    log("Script executed on %s using the command call: %s" % (timestamp(), ' '.join(sys.argv)))
+    log()
+    log("Using %s as the input mapping file." % args.mapping_file)
+    log(md5sum(args.mapping_file))
+    for description, fp in (('input seqs.fna file', args.seqs), ('raw Read 1 file', args.forward), ('raw Read 2 file', args.reverse)):
+        log("Using %s as the %s." % (fp, description))
+    log("The md5 checksums of these files are calculated while they are read and are listed once the reads are written.")
+
+    # The large inputs are checksummed on the bytes read for parsing, rather than reading them once more up front
+    digests = manifest_digests(args.sha256)
+    seqs_f = HashingFile(open(args.seqs, 'rb'), digests)
+    fwd_read_f = open_fastq(args.forward, digests)     # Plain or gzip compressed, from the first bytes of the file
+    rev_read_f = open_fastq(args.reverse, digests)
+    hashed_inputs = [(args.seqs, seqs_f), (args.forward, fwd_read_f.hashing_f), (args.reverse, rev_read_f.hashing_f)]
+
+    try:
+        sample_ids = sorted(set(check_map(args.mapping_file).values()))
+    except ParseError, e:
+        parser.error(str(e))
+    log()
+    log("There are %d samples in your mapfile." % len(sample_ids))
+    read_to_sample, sample_seq_counts = read_sample_ids(seqs_f, sample_ids)
+    for sample_num, sample_id in enumerate(sample_ids, 1):
+        log("Sample: %d   %s\t%d seqs" % (sample_num, sample_id, sample_seq_counts[sample_id]))
+
+    log()
+    log("%s: Proceeding to demultiplex the raw reads into per-sample R1 and R2 files." % timestamp())
+    output_fps = []
+    output_fs = {}
+    for sample_id in sample_ids:
+        output_r1 = '%s/%s_R1.fastq.gz' % (output_dir, sample_id)
+        output_r2 = '%s/%s_R2.fastq.gz' % (output_dir, sample_id)
+        output_fs[sample_id] = (GzipWriter(output_r1, args.compress_level, args.compress_threads, digests=digests),
+                                GzipWriter(output_r2, args.compress_level, args.compress_threads, digests=digests))
+        output_fps.extend([(output_r1, output_fs[sample_id][0]), (output_r2, output_fs[sample_id][1])])
+
+    # A single pass over the raw reads, sending each pair to the files of the sample it was assigned to in seqs.fna
+    for header_f, sequence_f, quality_f, header_r, sequence_r, quality_r in filter_paired_fastq(fwd_read_f, rev_read_f, read_to_sample):
+        output_r1_f, output_r2_f = output_fs[read_to_sample[header_f.split()[0]]]
+        output_r1_f.write('@%s\n%s\n+\n%s\n' % (header_f, sequence_f, quality_f))
+        output_r2_f.write('@%s\n%s\n+\n%s\n' % (header_r, sequence_r, quality_r))
+    for output_r1_f, output_r2_f in output_fs.values():
+        output_r1_f.close()
+        output_r2_f.close()
+    log("%s: Finished parsing out the raw Read1/Read2 files for each sample." % timestamp())
+
+    # md5 checksums are needed for SRA submissions, they were calculated while the files were read and written
+    log()
+    inputs = [input_entry(fp, hashing_f) for fp, hashing_f in hashed_inputs]
+    log("md5 checksum values of the input files:")
+    for entry in inputs:
+        log(md5sum_line(entry))
+    log()
+    log("md5 checksum values of the sample files:")
+    outputs = [output_entry(fp, writer) for fp, writer in sorted(output_fps, key=lambda output: output[0].endswith('_R2.fastq.gz'))]
+    for entry in outputs:
+        log(md5sum_line(entry, output_dir))    # Relative to md5sums.txt so it can be checked with md5sum -c
+    write_manifest('%s/%s' % (output_dir, MANIFEST_FILE), outputs, inputs)
+
+    log()
+    log("%s: Script is now finished." % timestamp())
+    log("Each sample should have a gzip compressed R1 and R2 read file that you will need to upload to the SRA.")
+    log("md5 checksum values have been calculated for these files and can be found in the md5sums.txt file, and with the")
+    log("file sizes and read counts in %s." % MANIFEST_FILE)
+    log_f.close()
+
+if __name__ == "__main__":
+    main()
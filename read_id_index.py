@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Compact read ID index shared by fastq_filter.py and dual_fastq_filter.py.
+
+Up to SET_MAX_IDS read IDs are kept as strings in a set, which is the fastest to look up. Above that, Illumina read
+names (instrument:run:flowcell:lane:tile:x:y) are packed into a single 64 bit integer and kept in a sorted array,
+costing 8 bytes per read ID instead of a full string in a set, and only other read names are kept in the set.
+A large names file can be converted once and the index then reloaded without reparsing the text,
+read_id_index.py -n Names.txt -o Names.idx
+"""
+import argparse
+import heapq
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+# Bit widths of the packed lane, tile, x and y fields, the remaining high bits number the instrument:run:flowcell prefix
+LANE_BITS = 4
+TILE_BITS = 17
+X_BITS = 19
+Y_BITS = 19
+PREFIX_BITS = 64 - LANE_BITS - TILE_BITS - X_BITS - Y_BITS
+MAX_PREFIXES = 1 << PREFIX_BITS
+PREFIX_SHIFT = LANE_BITS + TILE_BITS + X_BITS + Y_BITS
+FIELDS_MASK = (1 << PREFIX_SHIFT) - 1
+
+# Lists of up to this many read IDs are kept as strings in a set, longer ones are packed (about 120 bytes per ID in a set)
+SET_MAX_IDS = 4000000
+
+# A number with a leading zero in the lane:tile:x:y part of a read name, which has to be matched exactly as text
+LEADING_ZERO = re.compile(r':0[0-9]')
+
+# Packed IDs are sorted in chunks of this many and then merged, which keeps the peak memory of building the index low
+SORT_CHUNK = 1 << 20
+
+INDEX_MAGIC = 'READIDX\t1\n'
+
+if array('L').itemsize == 8:
+    PACKED_TYPECODE = 'L'
+else:
+    PACKED_TYPECODE = 'Q'   # Platforms where a C long is 32 bits (and Python versions that have the Q typecode)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--names', required=True, help="The file containing the read IDs to index. [REQUIRED]", metavar='Names.txt')
+parser.add_argument('-o', '--output', required=True, help="The read ID index file to create. [REQUIRED]", metavar='Names.idx')
+
+
+class ReadIDIndex(object):
+    """ A set-like collection of read IDs, supporting only 'in' and len() """
+
+    def __init__(self, read_ids=()):
+        self.prefix_ids = {}
+        self.fallback = set()       # Read IDs kept as strings, all of them unless there are more than SET_MAX_IDS
+        self.packed = array(PACKED_TYPECODE)
+        read_ids = iter(read_ids)
+        for read_id in read_ids:
+            self.fallback.add(read_id)
+            if len(self.fallback) > SET_MAX_IDS:
+                names, self.fallback = self.fallback, set()
+                self.pack_ids(chain(names, read_ids))
+                break
+
+    def pack_ids(self, read_ids):
+        """ Packs read IDs into the sorted array, keeping the ones that can't be packed in the set """
+        packed = self.packed
+        for read_id in read_ids:
+            packed_id = self.pack(read_id, add_prefix=True)
+            if packed_id is None:
+                self.fallback.add(read_id)
+            else:
+                packed.append(packed_id)
+        self.packed = sort_packed(packed)
+
+    def pack(self, read_id, add_prefix=False):
+        """ Returns the packed integer for an Illumina read name, or None if it can't be packed """
+        try:
+            prefix, lane, tile, x, y = read_id.rsplit(':', 4)
+        except ValueError:
+            return None
+        prefix_id = self.prefix_ids.get(prefix)
+        if prefix_id is None:
+            if not add_prefix or len(self.prefix_ids) == MAX_PREFIXES or prefix.count(':') != 2:
+                return None
+            prefix_id = self.prefix_ids[prefix] = len(self.prefix_ids)
+        if not (lane + tile + x + y).isdigit() or LEADING_ZERO.search(read_id, len(prefix)):
+            return None     # e.g. a tile of 01101, which would pack to the same integer as 1101 and has to match exactly
+        try:
+            lane, tile, x, y = int(lane), int(tile), int(x), int(y)
+        except ValueError:
+            return None     # An empty field
+        if lane >> LANE_BITS or tile >> TILE_BITS or x >> X_BITS or y >> Y_BITS:
+            return None
+        return ((((prefix_id << LANE_BITS | lane) << TILE_BITS | tile) << X_BITS | x) << Y_BITS) | y
+
+    def repack(self, seqs_to_keep):
+        """ Returns the set of packed IDs, in this index's packing, of a ReadIDIndex or a collection of read IDs """
+        wanted = set()
+        if isinstance(seqs_to_keep, ReadIDIndex):
+            prefix_map = {}
+            for prefix, prefix_id in seqs_to_keep.prefix_ids.iteritems():
+                if prefix in self.prefix_ids:
+                    prefix_map[prefix_id] = self.prefix_ids[prefix]
+            for packed_id in seqs_to_keep.packed:
+                prefix_id = prefix_map.get(packed_id >> PREFIX_SHIFT)
+                if prefix_id is not None:
+                    wanted.add(prefix_id << PREFIX_SHIFT | packed_id & FIELDS_MASK)
+            read_ids = seqs_to_keep.fallback
+        else:
+            read_ids = seqs_to_keep
+        for read_id in read_ids:
+            packed_id = self.pack(read_id.split()[0])
+            if packed_id is not None:
+                wanted.add(packed_id)
+        return wanted
+
+    def __contains__(self, read_id):
+        if not self.packed:
+            return read_id in self.fallback
+        packed_id = self.pack(read_id)
+        if packed_id is None:
+            return read_id in self.fallback
+        i = bisect_left(self.packed, packed_id)
+        return i != len(self.packed) and self.packed[i] == packed_id
+
+    def __len__(self):
+        return len(self.packed) + len(self.fallback)
+
+    def save(self, fp):
+        """ Writes the index to a file that can be reloaded with ReadIDIndex.load, with the Illumina read names packed """
+        if not self.packed and self.fallback:
+            index = ReadIDIndex()
+            index.pack_ids(self.fallback)
+            index.save(fp)
+            return
+        prefixes = sorted(self.prefix_ids, key=self.prefix_ids.get)
+        out_f = open(fp, 'wb')
+        out_f.write(INDEX_MAGIC)
+        out_f.write('%d\t%d\t%d\t%s\n' % (len(prefixes), len(self.fallback), len(self.packed), sys.byteorder))
+        for name in prefixes:
+            out_f.write(name + '\n')
+        for name in self.fallback:
+            out_f.write(name + '\n')
+        self.packed.tofile(out_f)
+        out_f.close()
+
+    @classmethod
+    def load(cls, fp):
+        """ Reads an index written by ReadIDIndex.save """
+        in_f = open(fp, 'rb')
+        if in_f.readline() != INDEX_MAGIC:
+            raise ValueError("%s is not a read ID index file." % fp)
+        num_prefixes, num_fallback, num_packed, byteorder = in_f.readline().split()
+        index = cls()
+        for prefix_id in range(int(num_prefixes)):
+            index.prefix_ids[in_f.readline().rstrip('\n')] = prefix_id
+        for i in range(int(num_fallback)):
+            index.fallback.add(in_f.readline().rstrip('\n'))
+        index.packed.fromfile(in_f, int(num_packed))
+        if byteorder != sys.byteorder:
+            index.packed.byteswap()
+        in_f.close()
+        if len(index) <= SET_MAX_IDS:
+            # Short enough to look up as strings, packed names unpack to exactly the names that were packed
+            prefix_names = sorted(index.prefix_ids, key=index.prefix_ids.get)
+            index.fallback.update(unpack_read_id(packed_id, prefix_names) for packed_id in index.packed)
+            index.packed = array(PACKED_TYPECODE)
+            index.prefix_ids = {}
+        return index
+
+
+def sort_packed(packed):
+    """ Sorts an array of packed IDs, a chunk at a time so that only one chunk is ever held as a list """
+    runs = [array(PACKED_TYPECODE, sorted(packed[i:i + SORT_CHUNK])) for i in range(0, len(packed), SORT_CHUNK)]
+    if len(runs) == 1:
+        return runs[0]
+    return array(PACKED_TYPECODE, heapq.merge(*runs))
+
+
+def unpack_read_id(packed_id, prefix_names):
+    """ Returns the Illumina read name of a packed ID, given the instrument:run:flowcell prefixes in prefix ID order """
+    y = packed_id & ((1 << Y_BITS) - 1)
+    x = packed_id >> Y_BITS & ((1 << X_BITS) - 1)
+    tile = packed_id >> (X_BITS + Y_BITS) & ((1 << TILE_BITS) - 1)
+    lane = packed_id >> (TILE_BITS + X_BITS + Y_BITS) & ((1 << LANE_BITS) - 1)
+    return '%s:%d:%d:%d:%d' % (prefix_names[packed_id >> PREFIX_SHIFT], lane, tile, x, y)
+
+
+def read_names(names_f):
+    """ Yields the read IDs of a names file, skipping comment and blank lines """
+    for line in names_f:
+        if line.strip() and not line.startswith('#'):
+            yield line.split()[0]
+
+
+def load_read_ids(fp):
+    """ Loads a read ID index file, or builds the index from a plain text names file """
+    names_f = open(fp, 'rb')
+    is_index = names_f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+    names_f.close()
+    if is_index:
+        return ReadIDIndex.load(fp)
+    return ReadIDIndex(read_names(open(fp, 'U')))
+
+
+def main():
+    args = parser.parse_args()
+    index = load_read_ids(args.names)
+    index.save(args.output)
+    print "Indexed %d read IDs into %s" % (len(index), args.output)
+
+if __name__ == "__main__":
+    main()
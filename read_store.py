@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Compact local store of a sequencing run, for filtering or demultiplexing the same run many times over.
+
+read_store.py -f Undetermined_R1.fastq.gz -r Undetermined_R2.fastq.gz -b Undetermined_I1.fastq.gz -o Run.fqstore
+converts the run once into a directory of column files:
+- the read names packed into 64 bit integers as in read_id_index.py (names that can't be packed are kept as text),
+  and the rest of each header (e.g. ' 1:N:0:1') as a number in a table of the distinct header endings,
+- the bases of each read packed 2 bits per base, with the positions of the Ns kept separately,
+- the quality strings, zlib compressed a chunk at a time,
+- the index reads as fixed width columns of sequences (their qualities aren't kept).
+
+Reads are stored in chunks of CHUNK_READS. Every column is a raw little-endian array described in store.json by its
+file, NumPy dtype and shape, so it can be memory-mapped with numpy.memmap. fastq_filter.py, dual_fastq_filter.py and
+demultiplex_reads.py take the store directory in place of their input fastq files. They select reads by scanning the
+ID or index columns a chunk at a time, vectorized with NumPy when it is installed, and only decode the reads that are
+written out as fastq.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import string
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+from itertools import compress, count, imap, islice, izip, izip_longest, product
+
+from fastq_input import open_fastq
+from fastq_offset_index import UNPACKED
+from fastq_parser import ParseError, fastqparser
+from read_id_index import PACKED_TYPECODE, ReadIDIndex, unpack_read_id
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # Columns are read with the array module instead
+
+STORE_FILE = 'store.json'
+STORE_FORMAT = 'fastq read store'
+STORE_VERSION = 1
+
+# Number of reads in each chunk, the unit that columns are scanned and qualities compressed in
+CHUNK_READS = 1 << 16
+
+QUALITY_COMPRESS_LEVEL = 6
+
+BASES = 'ACGT'
+ACGT_ONLY = string.maketrans('N', 'A')     # Ns are packed as A and put back from the N positions
+BASE_CODES = string.maketrans(BASES, '\x00\x01\x02\x03')
+
+# The 4 bases of every packed byte, first base in the high bits, and the reverse
+UNPACK_BYTE = [''.join(bases) for bases in product(BASES, repeat=4)]
+PACK_BYTE = dict((bases, chr(i)) for i, bases in enumerate(UNPACK_BYTE))
+
+# array typecodes of the column dtypes
+TYPECODES = {'<u8': PACKED_TYPECODE, '<u4': 'I', '<u2': 'H'}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--fwd_reads', required=True, help="The Read 1 fastq file to store, plain or gzip compressed. [REQUIRED]", metavar='Undetermined_R1.fastq.gz')
+parser.add_argument('-r', '--rev_reads', required=False, help="The Read 2 fastq file to store.", metavar='Undetermined_R2.fastq.gz')
+parser.add_argument('-b', '--index_reads', required=False, help="The index fastq file to store the index sequences of.", metavar='Undetermined_I1.fastq.gz')
+parser.add_argument('-d', '--index2_reads', required=False, help="The i5 index fastq file of dual-indexed runs.", metavar='Undetermined_I2.fastq.gz')
+parser.add_argument('-o', '--output', required=True, help="The read store directory to create. [REQUIRED]", metavar='Run.fqstore')
+parser.add_argument('--chunk_reads', required=False, type=int, default=CHUNK_READS, help="The number of reads in each chunk of the store. Default: %d" % CHUNK_READS, metavar='%d' % CHUNK_READS)
+
+
+def is_read_store(fp):
+    return fp is not None and os.path.isfile(os.path.join(fp, STORE_FILE))
+
+
+def pack_bases(bases):
+    """ Returns the bases of a string of A, C, G and T packed 4 to a byte, padded with A """
+    bases += 'A' * (-len(bases) % 4)
+    if numpy is not None:
+        codes = numpy.frombuffer(bases.translate(BASE_CODES), numpy.uint8).reshape(-1, 4)
+        return (codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]).astype(numpy.uint8).tostring()
+    return ''.join(map(PACK_BYTE.__getitem__, re.findall('....', bases)))
+
+
+def unpack_bases(data, length):
+    """ Returns the first length bases of packed data """
+    if numpy is not None:
+        packed = numpy.frombuffer(data, numpy.uint8)
+        codes = numpy.empty((len(packed), 4), numpy.uint8)
+        for i in range(4):
+            codes[:, i] = packed >> (6 - 2 * i) & 3
+        return numpy.frombuffer(BASES, numpy.uint8)[codes.ravel()[:length]].tostring()
+    return ''.join(map(UNPACK_BYTE.__getitem__, bytearray(data)))[:length]
+
+
+def n_positions(bases):
+    """ Returns the positions of the Ns in a string of bases """
+    if numpy is not None:
+        return numpy.flatnonzero(numpy.frombuffer(bases, numpy.uint8) == ord('N')).tolist()
+    positions = []
+    position = bases.find('N')
+    while position != -1:
+        positions.append(position)
+        position = bases.find('N', position + 1)
+    return positions
+
+
+def write_array(out_f, typecode, values):
+    """ Writes integers to a column file as a little-endian array """
+    values = array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    values.tofile(out_f)
+    return len(values)
+
+
+def split_headers(headers, names=None):
+    """ Returns the read names of headers and the rest of each header, checking the names against names if given """
+    read_names = [header.split(None, 1)[0] for header in headers]
+    if names is not None and read_names != names:
+        for i, (name1, name2) in enumerate(izip(names, read_names)):
+            if name1 != name2:
+                raise ParseError, ("Read names %s and %s don't match. Confirm that the fastq files you are passing match one another." % (name1, name2))
+    return read_names, [header[len(name):] for header, name in izip(headers, read_names)]
+
+
+class StoreWriter(object):
+    """ Writes the columns of a read store a chunk at a time """
+
+    def __init__(self, fp, read_names, index_names):
+        os.makedirs(fp)
+        self.fp = fp
+        self.read_names = read_names
+        self.index_names = index_names
+        self.ids = ReadIDIndex()    # Only used to pack read names, with its own instrument:run:flowcell prefixes
+        self.fallback = []          # (record number, read name) of the names that couldn't be packed
+        self.comments = dict((read, {}) for read in read_names)
+        self.index_widths = {}
+        self.columns = {}
+        self.files = {}
+        self.chunks = []
+        self.reads = 0
+        self.add_column('ids', '.u8', '<u8')
+        for read in read_names:
+            self.add_column('comments_' + read, '.u4', '<u4')
+            self.add_column('lengths_' + read, '.u2', '<u2')
+            self.add_column('bases_' + read, '.2bit', 'u1')
+            self.add_column('n_' + read, '.u8', '<u8')
+            self.add_column('quals_' + read, '.zlib', 'u1')
+
+    def add_column(self, name, extension, dtype):
+        self.columns[name] = {'file': name + extension, 'dtype': dtype, 'shape': [0]}
+        self.files[name] = open(os.path.join(self.fp, name + extension), 'wb')
+
+    def write(self, name, data, itemsize=1):
+        """ Writes a string of items of itemsize bytes, or a (typecode, values) array, to a column.
+
+        Returns the index in the column of the first item written.
+        """
+        start = self.columns[name]['shape'][0]
+        if isinstance(data, str):
+            self.files[name].write(data)
+            self.columns[name]['shape'][0] += len(data) / itemsize
+        else:
+            typecode, values = data
+            self.columns[name]['shape'][0] += write_array(self.files[name], typecode, values)
+        return start
+
+    def add_chunk(self, records):
+        """ Adds a chunk of records, a tuple of the (header, sequence, quality) of each read and then each index read """
+        chunk = {'reads': len(records)}
+        names = None
+        for read, read_records in izip(self.read_names + self.index_names, izip(*records)):
+            headers, sequences, qualities = izip(*read_records)
+            read_names, comments = split_headers(headers, names)
+            if names is None:
+                names = read_names
+                self.add_ids(names)
+            if read in self.index_names:
+                self.add_index(read, sequences)
+            else:
+                self.add_read(read, chunk, comments, sequences, qualities)
+        self.chunks.append(chunk)
+        self.reads += len(records)
+
+    def add_ids(self, names):
+        pack = self.ids.pack
+        packed_ids = []
+        for i, name in enumerate(names):
+            packed_id = pack(name, add_prefix=True)
+            if packed_id is None:
+                self.fallback.append((self.reads + i, name))
+                packed_id = UNPACKED
+            packed_ids.append(packed_id)
+        self.write('ids', (PACKED_TYPECODE, packed_ids))
+
+    def add_read(self, read, chunk, comments, sequences, qualities):
+        table = self.comments[read]
+        self.write('comments_' + read, ('I', [table.setdefault(comment, len(table)) for comment in comments]))
+        lengths = map(len, sequences)
+        if max(lengths) >> 16:
+            raise ParseError, ("Reads longer than 65535 bases can't be stored.")
+        self.write('lengths_' + read, ('H', lengths))
+        bases = ''.join(sequences)
+        if bases.translate(None, 'ACGTN'):
+            raise ParseError, ("Reads with bases other than A, C, G, T and N can't be stored.")
+        start = chunk['bases_' + read] = self.write('bases_' + read, pack_bases(bases.translate(ACGT_ONLY)))
+        n_start = self.write('n_' + read, (PACKED_TYPECODE, [4 * start + position for position in n_positions(bases)]))
+        chunk['n_' + read] = [n_start, self.columns['n_' + read]['shape'][0]]
+        chunk['quals_' + read] = [self.write('quals_' + read, zlib.compress(''.join(qualities), QUALITY_COMPRESS_LEVEL)),
+                                  self.columns['quals_' + read]['shape'][0]]
+
+    def add_index(self, read, sequences):
+        width = max(map(len, sequences))
+        if read not in self.index_widths:
+            self.index_widths[read] = width
+            self.add_column('index_' + read, '.txt', '|S%d' % width)
+        elif width > self.index_widths[read]:
+            raise ParseError, ("The %s index reads aren't all the same length." % read)
+        width = self.index_widths[read]
+        self.write('index_' + read, ''.join([sequence.ljust(width, '\x00') for sequence in sequences]), width)
+
+    def close(self, sources):
+        for name, out_f in self.files.items():
+            out_f.close()
+        for read, table in self.comments.items():
+            out_f = open(os.path.join(self.fp, 'comments_%s.txt' % read), 'w')
+            for comment in sorted(table, key=table.get):
+                out_f.write(comment + '\n')
+            out_f.close()
+        out_f = open(os.path.join(self.fp, 'fallback.txt'), 'w')
+        for record_num, name in self.fallback:
+            out_f.write('%d\t%s\n' % (record_num, name))
+        out_f.close()
+        meta = {'format': STORE_FORMAT, 'version': STORE_VERSION, 'reads': self.reads, 'reads_in_pair': self.read_names,
+                'index_reads': self.index_names, 'prefixes': sorted(self.ids.prefix_ids, key=self.ids.prefix_ids.get),
+                'sources': sources, 'columns': self.columns, 'chunks': self.chunks}
+        out_f = open(os.path.join(self.fp, STORE_FILE), 'w')
+        json.dump(meta, out_f, indent=1, sort_keys=True)
+        out_f.write('\n')
+        out_f.close()
+
+
+def build_store(fp, read_fps, index_fps=(), chunk_reads=CHUNK_READS):
+    """ Converts the fastq files of a run (R1 and optionally R2, then any index reads) into a read store """
+    read_names = ['R1', 'R2'][:len(read_fps)]
+    index_names = ['I1', 'I2'][:len(index_fps)]
+    writer = StoreWriter(fp + '.incomplete', read_names, index_names)   # Renamed once the whole run is stored
+    records = izip_longest(*[fastqparser(open_fastq(reads_fp)) for reads_fp in list(read_fps) + list(index_fps)])
+    while True:
+        chunk = list(islice(records, chunk_reads))
+        if not chunk:
+            break
+        if None in chunk[-1]:
+            raise ParseError, ("The fastq files don't have the same number of reads. Confirm that the fastq files you are passing match one another.")
+        writer.add_chunk(chunk)
+    sources = dict((name, os.path.abspath(reads_fp)) for name, reads_fp in zip(read_names + index_names, list(read_fps) + list(index_fps)))
+    writer.close(sources)
+    os.rename(writer.fp, fp)
+    writer.fp = fp
+    return writer
+
+
+class ReadStore(object):
+    """ A read store opened for reading """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.name = fp
+        in_f = open(os.path.join(fp, STORE_FILE))
+        meta = json.load(in_f)
+        in_f.close()
+        if meta.get('format') != STORE_FORMAT or meta.get('version') != STORE_VERSION:
+            raise ValueError("%s is not a read store of a version this script can read." % fp)
+        self.reads = meta['reads']
+        self.columns = meta['columns']
+        self.chunks = meta['chunks']
+        self.reads_in_pair = map(str, meta['reads_in_pair'])
+        self.index_reads = map(str, meta['index_reads'])
+        self.prefix_names = map(str, meta['prefixes'])
+        self.ids = ReadIDIndex()
+        self.ids.prefix_ids = dict((name, prefix_id) for prefix_id, name in enumerate(self.prefix_names))
+        self.comments = {}
+        for read in self.reads_in_pair:
+            self.comments[read] = [line.rstrip('\n') for line in open(os.path.join(fp, 'comments_%s.txt' % read))]
+        self.fallback = {}
+        for line in open(os.path.join(fp, 'fallback.txt')):
+            record_num, name = line.rstrip('\n').split('\t')
+            self.fallback[int(record_num)] = name
+        self.chunk_starts = []
+        start = 0
+        for chunk in self.chunks:
+            self.chunk_starts.append(start)
+            start += chunk['reads']
+        self.maps = {}
+
+    def __len__(self):
+        return self.reads
+
+    def column(self, name, start, stop):
+        """ Returns items start to stop of a column, as a NumPy array if NumPy is installed, else as an array or list """
+        info = self.columns[name]
+        fp = os.path.join(self.fp, info['file'])
+        if numpy is not None:
+            if name not in self.maps:
+                if info['shape'][0]:
+                    self.maps[name] = numpy.memmap(fp, numpy.dtype(str(info['dtype'])), 'r', shape=tuple(info['shape']))
+                else:
+                    self.maps[name] = numpy.zeros(0, numpy.dtype(str(info['dtype'])))    # Empty files can't be mapped
+            return self.maps[name][start:stop]
+        dtype = info['dtype']
+        itemsize = int(dtype[2:]) if dtype.startswith('|S') else int(dtype[-1])
+        in_f = open(fp, 'rb')
+        in_f.seek(start * itemsize)
+        data = in_f.read((stop - start) * itemsize)
+        in_f.close()
+        if dtype.startswith('|S'):
+            return [data[i:i + itemsize].rstrip('\x00') for i in xrange(0, len(data), itemsize)]
+        if dtype == 'u1':
+            return data
+        values = array(TYPECODES[dtype])
+        values.fromstring(data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def column_list(self, name, start, stop):
+        values = self.column(name, start, stop)
+        if numpy is not None:
+            return values.tolist()
+        return values
+
+    def column_bytes(self, name, start, stop):
+        data = self.column(name, start, stop)
+        if numpy is not None:
+            return data.tostring()
+        return data
+
+    def chunk_range(self, chunk_num):
+        start = self.chunk_starts[chunk_num]
+        return start, start + self.chunks[chunk_num]['reads']
+
+    def find(self, seqs_to_keep):
+        """ Returns the sorted record numbers of the reads whose IDs are in seqs_to_keep, scanning the ID column """
+        wanted = self.ids.repack(seqs_to_keep)
+        if numpy is not None:
+            wanted_ids = numpy.array(sorted(wanted), numpy.uint64)
+        record_nums = []
+        for chunk_num in xrange(len(self.chunks)):
+            start, stop = self.chunk_range(chunk_num)
+            ids = self.column('ids', start, stop)
+            if numpy is not None:
+                record_nums.extend((numpy.flatnonzero(numpy.in1d(ids, wanted_ids)) + start).tolist())
+            else:
+                record_nums.extend(compress(count(start), imap(wanted.__contains__, ids)))
+        fallback = [record_num for record_num, name in self.fallback.iteritems() if name in seqs_to_keep]
+        if fallback:
+            record_nums = sorted(record_nums + fallback)
+        return record_nums
+
+    def index_groups(self, chunk_num, classify):
+        """ Groups the reads of a chunk by classify(index), called once for each distinct index sequence of the chunk.
+
+        The index sequence is that of I1, or I1+I2 for stores with two index reads. Returns a dict of each class to the
+        offsets in the chunk of its reads, in order, and a list of the (index sequence, class, number of reads) found.
+        """
+        start, stop = self.chunk_range(chunk_num)
+        if numpy is not None:
+            indexes = self.column('index_I1', start, stop)
+            if 'I2' in self.index_reads:
+                indexes = numpy.char.add(numpy.char.add(indexes, '+'), self.column('index_I2', start, stop))
+            distinct, inverse = numpy.unique(indexes, return_inverse=True)
+            distinct = distinct.tolist()
+            classes = [classify(index) for index in distinct]
+            class_codes = {}
+            for klass in classes:
+                class_codes.setdefault(klass, len(class_codes))
+            read_codes = numpy.array([class_codes[klass] for klass in classes], numpy.intp)[inverse]
+            order = numpy.argsort(read_codes, kind='mergesort')     # Stable, so each class keeps the reads in order
+            bounds = numpy.cumsum(numpy.bincount(read_codes, minlength=len(class_codes))).tolist()
+            groups = {}
+            for klass, code in class_codes.iteritems():
+                groups[klass] = order[bounds[code - 1] if code else 0:bounds[code]].tolist()
+            index_counts = numpy.bincount(inverse, minlength=len(distinct)).tolist()
+            return groups, zip(distinct, classes, index_counts)
+        indexes = self.column('index_I1', start, stop)
+        if 'I2' in self.index_reads:
+            indexes = ['%s+%s' % pair for pair in izip(indexes, self.column('index_I2', start, stop))]
+        classes = {}
+        index_counts = {}
+        groups = {}
+        for offset, index in enumerate(indexes):
+            if index not in classes:
+                classes[index] = classify(index)
+                index_counts[index] = 0
+            index_counts[index] += 1
+            klass = classes[index]
+            if klass in groups:
+                groups[klass].append(offset)
+            else:
+                groups[klass] = [offset]
+        return groups, [(index, classes[index], index_counts[index]) for index in sorted(classes)]
+
+    def chunk_records(self, chunk_num, read, offsets=None):
+        """ Returns the (header without the @, sequence, quality) records of a read (e.g. 'R1') of a chunk.
+
+        Only the records at the given offsets in the chunk are returned if offsets is given.
+        """
+        chunk = self.chunks[chunk_num]
+        start, stop = self.chunk_range(chunk_num)
+        lengths = self.column_list('lengths_' + read, start, stop)
+        ends = []
+        end = 0
+        for length in lengths:
+            end += length
+            ends.append(end)
+        first_byte = chunk['bases_' + read]
+        bases = unpack_bases(self.column_bytes('bases_' + read, first_byte, first_byte + (end + 3) / 4), end)
+        n_start, n_stop = chunk['n_' + read]
+        if n_stop > n_start:
+            bases = bytearray(bases)
+            for position in self.column_list('n_' + read, n_start, n_stop):
+                bases[position - 4 * first_byte] = 'N'
+            bases = str(bases)
+        qualities = zlib.decompress(self.column_bytes('quals_' + read, *chunk['quals_' + read]))
+        ids = self.column_list('ids', start, stop)
+        comments = self.comments[read]
+        comment_codes = self.column_list('comments_' + read, start, stop)
+        if offsets is None:
+            offsets = xrange(stop - start)
+        prefix_names = self.prefix_names
+        records = []
+        for offset in offsets:
+            packed_id = ids[offset]
+            if packed_id == UNPACKED:
+                name = self.fallback[start + offset]
+            else:
+                name = unpack_read_id(packed_id, prefix_names)
+            read_start = ends[offset] - lengths[offset]
+            records.append((name + comments[comment_codes[offset]], bases[read_start:ends[offset]], qualities[read_start:ends[offset]]))
+        return records
+
+    def chunk_offsets(self, record_nums):
+        """ Yields the chunk number and the offsets in it of a sorted list of record numbers, chunk by chunk """
+        i = 0
+        while i < len(record_nums):
+            chunk_num = bisect_right(self.chunk_starts, record_nums[i]) - 1
+            start, stop = self.chunk_range(chunk_num)
+            j = bisect_right(record_nums, stop - 1, i)
+            yield chunk_num, [record_num - start for record_num in record_nums[i:j]]
+            i = j
+
+    def records(self, record_nums, read='R1'):
+        """ Yields the records of a read with the given sorted record numbers """
+        for chunk_num, offsets in self.chunk_offsets(record_nums):
+            for record in self.chunk_records(chunk_num, read, offsets):
+                yield record
+
+    def pairs(self, record_nums):
+        """ Yields the R1 and R2 records of the given sorted record numbers as (header, sequence, quality) * 2 tuples """
+        for chunk_num, offsets in self.chunk_offsets(record_nums):
+            for read1_data, read2_data in izip(self.chunk_records(chunk_num, 'R1', offsets), self.chunk_records(chunk_num, 'R2', offsets)):
+                yield read1_data + read2_data
+
+
+def main():
+    args = parser.parse_args()
+    if os.path.exists(args.output):
+        parser.error("%s already exists." % args.output)
+    if os.path.exists(args.output + '.incomplete'):
+        shutil.rmtree(args.output + '.incomplete')     # Left by a conversion that didn't finish
+    if args.index2_reads and not args.index_reads:
+        parser.error("-d can only be given along with -b.")
+    read_fps = [fp for fp in (args.fwd_reads, args.rev_reads) if fp]
+    index_fps = [fp for fp in (args.index_reads, args.index2_reads) if fp]
+    writer = build_store(args.output, read_fps, index_fps, args.chunk_reads)
+    size = sum([os.path.getsize(os.path.join(args.output, name)) for name in os.listdir(args.output)])
+    print "Stored %d reads (%s) in %s, %.1f MB" % (writer.reads, ', '.join(writer.read_names + writer.index_names), args.output, size / 1e6)
+
+if __name__ == "__main__":
+    main()
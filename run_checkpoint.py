@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Checkpoints for resuming demultiplex_reads.py after it has been killed or preempted.
+
+Every CHECKPOINT_READS input reads the output writers write out what they hold and sync their files, and
+demultiplex_checkpoint.json records the size of each output, the number of input reads done, the read counts of the
+log, and for each input the last access point (gzip member start or plain file block) before the next read along with
+the number of lines before it. On --resume the outputs are truncated to their checkpoint sizes and each input is read
+from its access point, skipping lines up to the next read, rather than from the start of the file. The checkpoint is
+written to a temporary file that is then renamed over the last one, so a crash while writing it leaves the last one.
+"""
+import json
+import os
+
+from fastq_input import StreamPosition
+
+CHECKPOINT_FILE = 'demultiplex_checkpoint.json'
+
+# Number of input reads between checkpoints
+CHECKPOINT_READS = 1000000
+
+
+def file_signature(fp):
+    """ Returns the path, size and modification time of a file, to check that it hasn't changed when resuming """
+    info = os.stat(fp)
+    return [fp, info.st_size, int(info.st_mtime)]
+
+
+def output_key(fp):
+    """ Returns the name an output is saved under in a checkpoint """
+    return os.path.basename(fp)     # The outputs are all in the checkpoint's directory, however it was written, e.g. Reads_folder/
+
+
+def load_checkpoint(fp, settings):
+    """ Returns the state saved by the last checkpoint, or None if there is none.
+
+    Raises ValueError if the checkpoint was written by a run with other settings or inputs than settings.
+    """
+    if not os.path.exists(fp):
+        return None
+    in_f = open(fp)
+    state = json.load(in_f)
+    in_f.close()
+    if state['settings'] != json.loads(json.dumps(settings)):
+        raise ValueError("%s was written by a run with other samples, options or input files, it can't be resumed." % fp)
+    return state
+
+
+class Checkpointer(object):
+    """ Saves the state of a run every `every` input reads (never if it is 0), starting from a loaded state if given """
+
+    def __init__(self, fp, settings, every=CHECKPOINT_READS, state=None):
+        self.fp = fp
+        self.settings = settings
+        self.every = every
+        self.state = state or {'reads': 0}
+        self.outputs = []   # (file path, GzipWriter) of the files written
+        self.inputs = []    # (file path, StreamPosition) of the files read
+
+    @property
+    def reads(self):
+        return self.state['reads']
+
+    def output_start(self, fp):
+        """ Returns the (size, lines) of an output at the loaded checkpoint, or None if it is started afresh.
+
+        Raises ValueError if a checkpoint is being resumed but has no entry for the output, as starting it afresh
+        would lose the reads written to it before the checkpoint.
+        """
+        if not self.reads:
+            return None
+        start = self.state.get('outputs', {}).get(output_key(fp))
+        if start is None:
+            raise ValueError("%s has no entry for %s, it can't be resumed." % (self.fp, fp))
+        return tuple(start)
+
+    def add_output(self, fp, writer):
+        self.outputs.append((fp, writer))
+
+    def input_position(self, fp):
+        """ Returns the StreamPosition to open an input with, starting at the read after the loaded checkpoint """
+        start = self.state.get('inputs', {}).get(fp)
+        if start is None:
+            position = StreamPosition()
+        else:
+            position = StreamPosition(start, self.reads)
+        self.inputs.append((fp, position))
+        return position
+
+    def due(self, reads):
+        """ Checks if a checkpoint is due after the given number of input reads """
+        return self.every and reads / self.every > self.state['reads'] / self.every
+
+    def save(self, reads, **counts):
+        """ Saves a checkpoint after the given number of input reads, along with the counts needed to carry on the log """
+        state = {'settings': self.settings, 'reads': reads,
+                 'outputs': dict((output_key(fp), writer.checkpoint()) for fp, writer in self.outputs),
+                 'inputs': dict((fp, position.resume_point(reads)) for fp, position in self.inputs)}
+        state.update(counts)
+        temp_fp = self.fp + '.tmp'
+        out_f = open(temp_fp, 'w')
+        json.dump(state, out_f, indent=2, sort_keys=True)
+        out_f.write('\n')
+        out_f.flush()
+        os.fsync(out_f.fileno())
+        out_f.close()
+        os.rename(temp_fp, self.fp)
+        self.state = state
+
+    def finish(self):
+        """ Removes the checkpoint once the run has finished """
+        if os.path.exists(self.fp):
+            os.remove(self.fp)
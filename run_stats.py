@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+__author__ = "Michael C. Nelson"
+__copyright__ = "Copyright 2015, Michael C. Nelson/University of Connecticut"
+__license__ = "GPL3"
+__version__ = "1.0"
+
+"""
+Optional run-time instrumentation for demultiplex_reads.py, dual_fastq_filter.py and fastq_filter.py.
+
+Reports progress with reads/s and an ETA, the time spent decompressing, parsing, processing (header checks, index
+matching and formatting) and compressing, the peak memory, and a census of the most common unmatched index sequences.
+Stage times are measured around whole blocks and writes rather than per read, so instrumentation stays cheap.
+
+Inputs opened with prefetch are decompressed and parsed on their own threads. For those, the time the main loop waited
+for parsed batches is reported per input and counted as parsing, and the input it waited on longest is named as the
+bottleneck.
+"""
+import json
+import os
+import resource
+import sys
+import time
+
+from fastq_input import PrefetchedRecords
+from fastq_parser import fastq_batches, fastqparser
+
+# Number of reads between progress checks, and the minimum number of seconds between progress lines
+PROGRESS_READS = 100000
+PROGRESS_SECONDS = 30.0
+
+# Below this fraction of the run spent waiting on prefetched inputs, processing is reported as the bottleneck
+BOTTLENECK_WAIT_FRACTION = 0.1
+
+# Number of unmatched index sequences reported, the census tracks ten times as many to keep the counts accurate
+CENSUS_SIZE = 20
+
+
+class HeavyHitters(object):
+    """ Bounded-memory counter of the most frequent items (Misra-Gries).
+
+    At most capacity items are tracked. When a new item arrives and the counter is full, every count is decremented and
+    the items that reach zero are dropped, so the total work is linear in the number of items. Counts are lower bounds
+    that are low by at most dropped, which is never more than the number of items added / (capacity + 1).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.dropped = 0    # Total of all decrements, the bound on how low any count can be
+
+    def add(self, item, count=1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+            return
+        counts[item] = count
+        if len(counts) > self.capacity:
+            decrement = min(counts.itervalues())
+            self.dropped += decrement
+            for key, value in counts.items():
+                if value == decrement:
+                    del counts[key]
+                else:
+                    counts[key] = value - decrement
+
+    def most_common(self, n):
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+class TimedFile(object):
+    """ Wraps an input file, adding the time spent in read() to a stage of a RunStats """
+
+    def __init__(self, in_f, stats, stage):
+        self.in_f = in_f
+        self.stats = stats
+        self.stage = stage
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.in_f.read(size)
+        self.stats.stage_seconds[self.stage] += time.time() - start
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.in_f, name)
+
+
+class TimedWriter(object):
+    """ Wraps an output writer, adding the time spent in write() and close() to the compress stage of a RunStats """
+
+    def __init__(self, out_f, stats):
+        self.out_f = out_f
+        self.stats = stats
+
+    def write(self, data):
+        start = time.time()
+        self.out_f.write(data)
+        self.stats.stage_seconds['compress'] += time.time() - start
+
+    def close(self):
+        start = time.time()
+        self.out_f.close()
+        self.stats.stage_seconds['compress'] += time.time() - start
+
+    def __getattr__(self, name):
+        return getattr(self.out_f, name)
+
+
+def input_position(in_f):
+    """ Returns how far into the file on disk an input file has been read, using the compressed position of gzip files """
+    return getattr(in_f, 'fileobj', in_f).tell()
+
+
+def input_size(in_f):
+    return os.fstat(getattr(in_f, 'fileobj', in_f).fileno()).st_size
+
+
+def parse_records(in_f, stats=None):
+    """ Returns the records of an input file, timed by stats if it is given """
+    if isinstance(in_f, PrefetchedRecords):
+        if stats is not None:
+            stats.streams.append(in_f)
+        return iter(in_f)
+    if stats is None:
+        return fastqparser(in_f)
+    return stats.records(in_f)
+
+
+def count_records(records, stats):
+    """ Passes records through, reporting the number of reads read so far to stats """
+    reads = 0
+    for record in records:
+        reads += 1
+        if not reads % PROGRESS_READS:
+            stats.progress(reads)
+        yield record
+    stats.reads = reads
+
+
+def count_batches(batches, stats):
+    """ Passes batches of records through, reporting the number of reads read so far to stats """
+    reads = 0
+    for batch in batches:
+        reads += len(batch)
+        stats.progress(reads)
+        yield batch
+
+
+class RunStats(object):
+    """ Collects progress, stage times, peak memory and the unmatched index census of one run """
+
+    def __init__(self, progress_f=None, census_size=CENSUS_SIZE, progress_seconds=PROGRESS_SECONDS, log_f=sys.stderr):
+        self.start = time.time()
+        self.last_progress = self.start
+        self.progress_seconds = progress_seconds
+        self.log_f = log_f
+        self.progress_f = progress_f    # The input file whose position is used for the ETA
+        try:
+            self.total_bytes = input_size(progress_f)
+        except (AttributeError, TypeError, OSError, IOError):
+            self.total_bytes = None
+        self.stage_seconds = {'decompress': 0.0, 'read_parse': 0.0, 'compress': 0.0}
+        self.census_size = census_size
+        self.census = HeavyHitters(10 * census_size)
+        self.reads = 0
+        self.start_reads = 0        # Reads done before a resumed run started, which aren't counted in its rate
+        self.start_fraction = 0.0
+        self.streams = []   # Prefetched inputs, whose waits are timed by their queues
+
+    def records(self, in_f):
+        """ Yields the records of an input file like fastqparser, timing decompression and parsing """
+        if isinstance(in_f, PrefetchedRecords):
+            return parse_records(in_f, self)
+        return self.timed_records(in_f)
+
+    def timed_records(self, in_f):
+        batches = fastq_batches(TimedFile(in_f, self, 'decompress'))
+        while True:
+            start = time.time()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                break
+            finally:
+                self.stage_seconds['read_parse'] += time.time() - start
+            for record in batch:
+                yield record
+
+    def stream_waits(self):
+        """ Returns the seconds the main loop waited for and the seconds the input thread was blocked on each prefetched input """
+        return dict((stream.name, {'wait_seconds': round(stream.batches.wait_seconds, 3),
+                                   'blocked_seconds': round(stream.batches.blocked_seconds, 3)})
+                    for stream in self.streams)
+
+    def bottleneck(self, elapsed):
+        """ Returns the name of the prefetched input the main loop waited on longest, or 'processing' if it hardly waited """
+        stream = max(self.streams, key=lambda stream: stream.batches.wait_seconds)
+        if stream.batches.wait_seconds < BOTTLENECK_WAIT_FRACTION * elapsed:
+            return 'processing'
+        return stream.name
+
+    def resume(self, reads):
+        """ Counts only the reads after the given number, done by the run being resumed, and the input read after them """
+        self.start_reads = reads
+        if self.total_bytes:
+            self.start_fraction = float(input_position(self.progress_f)) / self.total_bytes
+
+    def unmatched(self, barcode, count=1):
+        self.census.add(barcode, count)
+
+    def progress(self, reads):
+        """ Writes a progress line if enough time has passed since the last one """
+        self.reads = reads
+        now = time.time()
+        if now - self.last_progress < self.progress_seconds:
+            return
+        self.last_progress = now
+        elapsed = now - self.start
+        line = "%s: %d reads, %.0f reads/s" % (time.strftime('%Y-%m-%d %H:%M:%S'), reads, (reads - self.start_reads) / elapsed)
+        if self.total_bytes:
+            fraction = float(input_position(self.progress_f)) / self.total_bytes
+            if fraction > self.start_fraction:
+                line += ", %.1f%% done, ETA %.0f s" % (100 * fraction, elapsed * (1 - fraction) / (fraction - self.start_fraction))
+        self.log_f.write(line + '\n')
+        self.log_f.flush()
+
+    def summary(self, **extra):
+        """ Returns the stats of the finished run as a dict, from the start of this run if it was resumed """
+        reads = self.reads - self.start_reads
+        elapsed = time.time() - self.start
+        # Prefetched inputs are decompressed and parsed alongside the main loop, which only waits when one falls behind
+        read_parse = self.stage_seconds['read_parse'] + sum(stream.batches.wait_seconds for stream in self.streams)
+        stage_seconds = {'decompress': self.stage_seconds['decompress'],
+                         'parse': read_parse - self.stage_seconds['decompress'],
+                         'compress': self.stage_seconds['compress']}
+        stage_seconds['process'] = elapsed - sum(stage_seconds.values())    # Header checks, index matching and formatting
+        summary = {'input_reads': reads, 'elapsed_seconds': round(elapsed, 3), 'reads_per_s': round(reads / max(elapsed, 1e-9), 1),
+                   'stage_seconds': dict((stage, round(seconds, 3)) for stage, seconds in stage_seconds.items()),
+                   'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)}
+        if self.census.counts:
+            summary['unmatched_barcodes'] = [{'barcode': barcode, 'count': count} for barcode, count in self.census.most_common(self.census_size)]
+            summary['unmatched_barcode_max_undercount'] = self.census.dropped
+        if self.streams:
+            summary['input_streams'] = self.stream_waits()
+            summary['bottleneck'] = self.bottleneck(elapsed)
+        summary.update(extra)
+        return summary
+
+    def write_json(self, fp, **extra):
+        out_f = open(fp, 'w')
+        json.dump(self.summary(**extra), out_f, indent=2, sort_keys=True)
+        out_f.write('\n')
+        out_f.close()